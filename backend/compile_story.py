@@ -0,0 +1,48 @@
+"""Precompile a story's choice tree into a static bundle.
+
+Usage:
+    python compile_story.py <story_id> [--depth 3] [--branching 3] [--concurrency 4] [--no-media]
+
+The bundle is stored in the state backend, where the interactive routes pick it
+up for new sessions, and written to static/bundles/<story_id>.json for caching
+or CDN distribution.
+"""
+import argparse
+import asyncio
+import sys
+from services.gemini_service import GeminiService
+from services.state_backend import state_backend
+from services.story_compiler import CompileError, StoryCompiler
+
+
+async def main(args) -> int:
+    story = state_backend.get("stories", args.story_id)
+    if story is None:
+        print(f"Story not found: {args.story_id}")
+        return 1
+
+    compiler = StoryCompiler(GeminiService(), state_backend)
+    try:
+        bundle = await compiler.compile(
+            story,
+            depth=args.depth,
+            branching=args.branching,
+            concurrency=args.concurrency,
+            include_media=not args.no_media
+        )
+        path = compiler.save(bundle)
+    except CompileError as e:
+        print(f"Could not compile story {args.story_id}: {str(e)}")
+        return 1
+    print(f"Compiled {len(bundle['nodes'])} scenes for story {args.story_id} into {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompile a story's choice tree into a static bundle")
+    parser.add_argument("story_id")
+    parser.add_argument("--depth", type=int, default=3, help="number of choices deep to compile")
+    parser.add_argument("--branching", type=int, default=3, help="choices followed per scene")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel Gemini calls")
+    parser.add_argument("--no-media", action="store_true", help="leave media references out of the bundle")
+    sys.exit(asyncio.run(main(parser.parse_args())))
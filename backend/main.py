@@ -1,8 +1,13 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+import asyncio
 import os
 from routes import stories, interactive, media
+from services.state_backend import state_backend
+from services.circuit_breaker import circuit_breaker_states
+from services.admission import admission_controller
+from services.compression import CompressionMiddleware
 from decouple import config
 
 app = FastAPI(
@@ -20,6 +25,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress JSON and text responses above the size threshold
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=config('COMPRESSION_MIN_SIZE', default=1024, cast=int)
+)
+
 # Create directories for static files
 os.makedirs("static/images", exist_ok=True)
 os.makedirs("static/audio", exist_ok=True)
@@ -33,14 +44,38 @@ app.include_router(stories.router, prefix="/api/v1/stories", tags=["Stories"])
 app.include_router(interactive.router, prefix="/api/v1/interactive", tags=["Interactive"])
 app.include_router(media.router, prefix="/api/v1/media", tags=["Media"])
 
+@app.on_event("startup")
+async def warm_indexes():
+    # Build the search and near-duplicate indexes in the background rather than on the first request
+    loop = asyncio.get_running_loop()
+    loop.run_in_executor(None, stories.search_service.warm)
+    loop.run_in_executor(None, stories.similarity_service.warm)
+    admission_controller.reset_worker()
+
+@app.on_event("shutdown")
+async def release_admission_counts():
+    # Stop counting this worker's requests against the shared provider capacity
+    admission_controller.reset_worker()
+
 @app.get("/")
 async def root():
     return {"message": "Smart Cultural Storyteller API", "version": "1.0.0"}
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "state_backend": state_backend.name,
+        "circuit_breakers": circuit_breaker_states(),
+        "admission": admission_controller.snapshot()
+    }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Workers share stories, sessions and media jobs through the state backend
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=config('WEB_CONCURRENCY', default=1, cast=int)
+    )
@@ -36,10 +36,14 @@ class StoryResponse(BaseModel):
     language: Language
     culture: str
     story_type: StoryType
+    tags: List[str] = Field(default_factory=list)
     interactive_enabled: bool = False
     choices: List[InteractiveChoice] = Field(default_factory=list)
     audio_url: Optional[str] = None
     image_url: Optional[str] = None
+    image_thumbnail_url: Optional[str] = None
+    derived_from: Optional[str] = None
+    audio_variants: Dict[str, str] = Field(default_factory=dict)
 
 class InteractiveSession(BaseModel):
     session_id: str
@@ -47,7 +51,10 @@ class InteractiveSession(BaseModel):
     current_scene: str
     story_history: List[str] = Field(default_factory=list)
     current_choices: List[InteractiveChoice] = Field(default_factory=list)
+    previous_choice: Optional[InteractiveChoice] = None
     language: Language = Language.ENGLISH
+    bundle_id: Optional[str] = None
+    bundle_node: Optional[str] = None
 
 class ChoiceSelection(BaseModel):
     session_id: str
@@ -58,6 +65,7 @@ class AudioRequest(BaseModel):
     language: Language = Language.ENGLISH
     voice_style: str = Field(default="narrative", pattern=r"^(narrative|dramatic|calm|energetic)$")
     accent: Optional[str] = None
+    quality: Optional[str] = Field(default=None, pattern=r"^(low|standard|high)$")
 
 class VisualRequest(BaseModel):
     description: str
@@ -1,14 +1,40 @@
-from fastapi import APIRouter, HTTPException, Request
-from typing import Dict
+from fastapi import APIRouter, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from typing import List, Optional
+import asyncio
+import json
+import os
 import uuid
+from decouple import config
 from models.schemas import InteractiveSession, ChoiceSelection, InteractiveChoice
 from services.gemini_service import GeminiService
+from services.visual_service import VisualService, IMAGE_STYLES
+from services.audio_service import AudioService, AUDIO_QUALITY_TIERS
+from services.state_backend import state_backend
+from services.deadline import Deadline
+from services.admission import admission_controller
+from services.story_compiler import StoryCompiler
+from services.scene_media import SceneMediaService, SCENE_MEDIA_KINDS, scene_key
+from services.serialization import make_etag, cache_headers, is_not_modified, not_modified_response
 
 router = APIRouter()
 gemini_service = GeminiService()
 
-# In-memory storage for interactive sessions
-sessions_db: Dict[str, dict] = {}
+# Interactive sessions, visible to every worker through the state backend
+# Session ETags use each record's version; no one lists sessions, so no collection-wide version
+sessions_db = state_backend.collection("sessions", versioned=True, collection_version=False)
+
+# Precompiled choice trees, served without calling Gemini
+story_compiler = StoryCompiler(gemini_service, state_backend)
+
+# Per-scene narration and art, generated only when a client asks for it
+scene_media = SceneMediaService(gemini_service, VisualService(), AudioService(), state_backend)
+
+# WebSocket transport settings
+WS_SEND_QUEUE_SIZE = config('WS_SEND_QUEUE_SIZE', default=256, cast=int)
+WS_SEND_TIMEOUT = config('WS_SEND_TIMEOUT', default=10.0, cast=float)
+WS_HEARTBEAT_INTERVAL = config('WS_HEARTBEAT_INTERVAL', default=20.0, cast=float)
+WS_HEARTBEAT_TIMEOUT = config('WS_HEARTBEAT_TIMEOUT', default=60.0, cast=float)
+WS_MEDIA_POLL_INTERVAL = config('WS_MEDIA_POLL_INTERVAL', default=2.0, cast=float)
 
 @router.post("/start/{story_id}")
 async def start_interactive_session(story_id: str, request: Request):
@@ -40,13 +66,20 @@ async def start_interactive_session(story_id: str, request: Request):
             for i, choice in enumerate(story.get("choices", []))
         ]
         
+        # Sessions of compiled stories start at the bundle's root and stay on it while they can
+        bundle = story_compiler.load(story_id, story)
+        if bundle:
+            choices = [_strip_link(choice) for choice in bundle["nodes"][bundle["root"]]["choices"]]
+        
         session = InteractiveSession(
             session_id=session_id,
             story_id=story_id,
             current_scene=story["enhanced_content"][:500],
             story_history=[story["enhanced_content"][:500]],
             current_choices=choices,
-            language=language
+            language=language,
+            bundle_id=bundle["bundle_id"] if bundle else None,
+            bundle_node=bundle["root"] if bundle else None
         )
         
         sessions_db[session_id] = session.model_dump()
@@ -61,77 +94,362 @@ async def start_interactive_session(story_id: str, request: Request):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error starting session: {str(e)}")
 
+def _strip_link(choice: dict) -> dict:
+    return {key: value for key, value in choice.items() if key != "next"}
+
+def _bundled_turn(session: dict, choice_id: str):
+    """Next node id and node for a choice covered by the session's compiled bundle"""
+    if not session.get("bundle_node"):
+        return None
+    bundle = story_compiler.get(session["bundle_id"], session["story_id"])
+    node = bundle["nodes"].get(session["bundle_node"]) if bundle else None
+    choice = next((c for c in node["choices"] if c["choice_id"] == choice_id), None) if node else None
+    if not choice or not choice["next"]:
+        return None
+    return choice["next"], bundle["nodes"][choice["next"]]
+
+def _load_turn(session_id: str, choice_id: str):
+    """Fetch the session, the selected choice and the story for a new turn"""
+    session = sessions_db.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    # Get the selected choice
+    selected_choice = next(
+        (choice for choice in session["current_choices"] if choice["choice_id"] == choice_id),
+        None
+    )
+    
+    if not selected_choice:
+        raise HTTPException(status_code=400, detail="Invalid choice")
+    
+    # Get the story
+    from routes.stories import stories_db
+    story = stories_db.get(session["story_id"])
+    if not story:
+        raise HTTPException(status_code=404, detail="Story not found")
+    
+    return session, selected_choice, story
+
+def _record_turn(
+    session_id: str,
+    session: dict,
+    selected_choice: dict,
+    next_scene: str,
+    new_choices: List[InteractiveChoice],
+    bundle_node: Optional[str] = None
+) -> dict:
+    """Persist a completed turn and return its client payload"""
+    if session.get("bundle_node"):
+        # Compiled scenes recur across sessions, so their choice counts rank media prefetches
+        scene_media.record_choice(session["current_scene"], session.get("language", "en"), selected_choice["choice_id"])
+    session["story_history"].append(next_scene)
+    session["current_scene"] = next_scene
+    session["previous_choice"] = selected_choice
+    session["current_choices"] = [choice.model_dump() for choice in new_choices]
+    # Once a session leaves its bundle it is played live from then on
+    session["bundle_node"] = bundle_node
+    
+    # Save updated session
+    sessions_db[session_id] = session
+    
+    return {
+        "session_id": session_id,
+        "current_scene": session["current_scene"],
+        "choices": session["current_choices"],
+        "previous_choice": session["previous_choice"],
+        "language": session.get("language", "en")  # Default to English if not set
+    }
+
 @router.post("/choose")
 async def make_choice(choice_selection: ChoiceSelection, request: Request):
     """Make a choice in an interactive story"""
     try:
         session_id = choice_selection.session_id
-        choice_id = choice_selection.choice_id
-        
-        if session_id not in sessions_db:
-            raise HTTPException(status_code=404, detail="Session not found")
-            
-        session_data = sessions_db[session_id]
-        session = InteractiveSession(**session_data)
-        
-        # Get the selected choice
-        selected_choice = next(
-            (choice for choice in session.current_choices if choice["choice_id"] == choice_id),
-            None
-        )
+        session, selected_choice, story = _load_turn(session_id, choice_selection.choice_id)
         
-        if not selected_choice:
-            raise HTTPException(status_code=400, detail="Invalid choice")
+        bundled = _bundled_turn(session, selected_choice["choice_id"])
+        if bundled:
+            node_id, node = bundled
+            return _record_turn(
+                session_id, session, selected_choice, node["scene"],
+                [InteractiveChoice(**choice) for choice in node["choices"]], node_id
+            )
         
-        # Get the story
-        from routes.stories import stories_db
-        story = stories_db.get(session.story_id)
-        if not story:
-            raise HTTPException(status_code=404, detail="Story not found")
-        
-        # Generate the next segment based on the choice
-        # This is where you would typically call your LLM to generate the next part of the story
-        # For now, we'll just create a simple response
-        next_scene = f"You chose: {selected_choice['choice_text']}. The story continues..."
+        # Continue the story and offer new choices within the endpoint's deadline;
+        # a slow or failing provider degrades to the service fallbacks
+        deadline = Deadline.for_endpoint("choose")
+        with admission_controller.track("gemini"):
+            next_scene = await gemini_service.continue_interactive_story(
+                session["story_history"],
+                selected_choice["choice_text"],
+                deadline
+            )
+            new_choices = await gemini_service.generate_interactive_choices(
+                story["enhanced_content"],
+                next_scene,
+                deadline
+            )
         
-        # Update session
-        session.story_history.append(next_scene)
-        session.current_scene = next_scene
-        session.previous_choice = selected_choice
+        return _record_turn(session_id, session, selected_choice, next_scene, new_choices)
         
-        # Generate new choices (in a real app, these would come from your LLM)
-        new_choices = [
-            {
-                "choice_id": f"choice_{i+1}",
-                "choice_text": f"Option {i+1} for '{selected_choice['choice_text']}'",
-                "consequence": f"You chose option {i+1} after {selected_choice['choice_text']}"
-            }
-            for i in range(2)  # Just 2 options for simplicity
-        ]
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing choice: {str(e)}")
+
+def _parse_kinds(kinds: str) -> List[str]:
+    requested = [kind.strip() for kind in kinds.split(",") if kind.strip()]
+    unknown = [kind for kind in requested if kind not in SCENE_MEDIA_KINDS]
+    if unknown or not requested:
+        raise HTTPException(status_code=400, detail=f"Unknown media kinds: {', '.join(unknown) or kinds}")
+    return requested
+
+def _likely_next_scene(session: dict) -> Optional[str]:
+    """Scene behind the most popular choice of a compiled scene, if the bundle covers it"""
+    if not session.get("bundle_node"):
+        return None
+    bundle = story_compiler.get(session["bundle_id"], session["story_id"])
+    node = bundle["nodes"].get(session["bundle_node"]) if bundle else None
+    if not node:
+        return None
+    linked = {choice["choice_id"]: choice["next"] for choice in node["choices"] if choice["next"]}
+    choice_id = scene_media.likely_choice(session["current_scene"], session.get("language", "en"), list(linked))
+    return bundle["nodes"][linked[choice_id]]["scene"] if choice_id else None
+
+def _request_scene_media(session_id: str, kinds: List[str], quality: str, style: str) -> dict:
+    """Start media for the session's current scene and prefetch the likely next one"""
+    session = sessions_db.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    from routes.stories import stories_db
+    story = stories_db.get(session["story_id"]) or {}
+    context = f"{story.get('culture', '')} {story.get('story_type', '')}".strip()
+    language = session.get("language", "en")
+    
+    media = scene_media.ensure(session["current_scene"], language, context, kinds, quality, style)
+    next_scene = _likely_next_scene(session)
+    if next_scene:
+        scene_media.ensure(next_scene, language, context, kinds, quality, style, prefetch=True)
+    
+    return {
+        "session_id": session_id,
+        "scene_key": scene_key(session["current_scene"], language),
+        "media": media,
+        "prefetched": next_scene is not None
+    }
+
+@router.post("/session/{session_id}/scene-media")
+async def get_scene_media(
+    session_id: str,
+    kinds: str = Query(",".join(SCENE_MEDIA_KINDS)),
+    quality: str = Query("standard", pattern=r"^(low|standard|high)$"),
+    style: str = Query("illustration", pattern=r"^(illustration|realistic|cartoon|traditional_art)$")
+):
+    """Media for the session's current scene, generating whatever is missing.
+
+    Poll until each kind is ``completed``; media shared with other sessions at
+    the same scene is returned straight away.
+    """
+    requested = _parse_kinds(kinds)
+    try:
+        return _request_scene_media(session_id, requested, quality, style)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating scene media: {str(e)}")
+
+async def _stream_turn(session_id: str, choice_id: str, push) -> None:
+    """Play one turn over a WebSocket, pushing scene text as it is generated"""
+    try:
+        session, selected_choice, story = _load_turn(session_id, choice_id)
         
-        session.current_choices = new_choices
+        bundled = _bundled_turn(session, selected_choice["choice_id"])
+        if bundled:
+            node_id, node = bundled
+            await push({"type": "scene_token", "text": node["scene"]})
+            await push({"type": "scene", **_record_turn(
+                session_id, session, selected_choice, node["scene"],
+                [InteractiveChoice(**choice) for choice in node["choices"]], node_id
+            )})
+            return
         
-        # Save updated session
-        sessions_db[session_id] = session.model_dump()
+        deadline = Deadline.for_endpoint("choose")
+        parts = []
+        with admission_controller.track("gemini"):
+            async for text in gemini_service.stream_interactive_story(
+                session["story_history"],
+                selected_choice["choice_text"],
+                deadline
+            ):
+                parts.append(text)
+                await push({"type": "scene_token", "text": text})
+            
+            next_scene = "".join(parts).strip()
+            new_choices = await gemini_service.generate_interactive_choices(
+                story["enhanced_content"],
+                next_scene,
+                deadline
+            )
+        await push({"type": "scene", **_record_turn(session_id, session, selected_choice, next_scene, new_choices)})
         
-        return {
+    except HTTPException as e:
+        await push({"type": "error", "detail": e.detail})
+    except WebSocketDisconnect:
+        raise
+    except Exception as e:
+        await push({"type": "error", "detail": f"Error processing choice: {str(e)}"})
+
+async def _watch_media(session_id: str, push) -> None:
+    """Notify the client once media files for the session's story or current scene exist on disk"""
+    from routes.stories import stories_db
+    notified = set()
+    while True:
+        session = sessions_db.get(session_id)
+        story = stories_db.get(session["story_id"]) if session else None
+        for media_type in ("audio", "image"):
+            url = story.get(f"{media_type}_url") if story else None
+            if url and url not in notified and os.path.exists(url.lstrip("/")):
+                notified.add(url)
+                await push({"type": "media_ready", "media_type": media_type, "url": url})
+        if session:
+            language = session.get("language", "en")
+            key = scene_key(session["current_scene"], language)
+            variants = [("audio", quality, "illustration") for quality in AUDIO_QUALITY_TIERS]
+            variants += [("image", "standard", style) for style in IMAGE_STYLES]
+            for kind, quality, style in variants:
+                media = scene_media.status(session["current_scene"], language, (kind,), quality, style)[kind]
+                if media["url"] and media["url"] not in notified:
+                    notified.add(media["url"])
+                    await push({"type": "media_ready", "media_type": kind, "url": media["url"], "scene_key": key})
+        await asyncio.sleep(WS_MEDIA_POLL_INTERVAL)
+
+@router.websocket("/session/{session_id}/ws")
+async def session_socket(websocket: WebSocket, session_id: str):
+    """Play a session over a WebSocket.
+
+    Clients send ``{"type": "choose", "choice_id": ...}``, ``{"type": "scene_media",
+    "kinds": [...]}`` and ``{"type": "ping"}``; the server pushes ``scene_token``,
+    ``scene``, ``scene_media``, ``media_ready``, ``ping``/``pong`` and ``error``
+    messages. Clients silent for longer than the heartbeat timeout, or too slow
+    to drain their send queue, are disconnected.
+    """
+    if session_id not in sessions_db:
+        await websocket.close(code=4404)
+        return
+    
+    await websocket.accept()
+    outbox: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+    
+    async def push(message: dict) -> None:
+        # Producers wait while the client catches up; a client that stays behind is dropped
+        try:
+            await asyncio.wait_for(outbox.put(message), timeout=WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            await _close_quietly(websocket, code=1013)
+            raise WebSocketDisconnect(code=1013)
+    
+    async def sender() -> None:
+        while True:
+            await websocket.send_json(await outbox.get())
+    
+    async def heartbeat() -> None:
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            await push({"type": "ping"})
+    
+    tasks = [
+        asyncio.create_task(sender()),
+        asyncio.create_task(heartbeat()),
+        asyncio.create_task(_watch_media(session_id, push))
+    ]
+    for task in tasks:
+        task.add_done_callback(_retrieve_result)
+    turn = None
+    try:
+        session = sessions_db[session_id]
+        await push({
+            "type": "session",
             "session_id": session_id,
-            "current_scene": session.current_scene,
-            "choices": session.current_choices,
-            "previous_choice": session.previous_choice,
-            "language": getattr(session, 'language', 'en')  # Default to English if not set
-        }
+            "current_scene": session["current_scene"],
+            "choices": session["current_choices"],
+            "language": session.get("language", "en")
+        })
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing choice: {str(e)}")
+        while True:
+            received = await asyncio.wait_for(websocket.receive(), timeout=WS_HEARTBEAT_TIMEOUT)
+            if received["type"] == "websocket.disconnect":
+                break
+            try:
+                message = json.loads(received.get("text") or "")
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                await push({"type": "error", "detail": "Messages must be JSON objects"})
+                continue
+            
+            message_type = message.get("type")
+            if message_type == "ping":
+                await push({"type": "pong"})
+            elif message_type == "pong":
+                continue
+            elif message_type == "choose":
+                if turn and not turn.done():
+                    await push({"type": "error", "detail": "A choice is already being processed"})
+                    continue
+                turn = asyncio.create_task(_stream_turn(session_id, message.get("choice_id"), push))
+                turn.add_done_callback(_retrieve_result)
+            elif message_type == "scene_media":
+                try:
+                    kinds = message.get("kinds") or list(SCENE_MEDIA_KINDS)
+                    if not isinstance(kinds, list) or not all(isinstance(kind, str) for kind in kinds):
+                        raise HTTPException(status_code=400, detail="kinds must be a list of media kinds")
+                    kinds = _parse_kinds(",".join(kinds))
+                    quality = message.get("quality", "standard")
+                    if quality not in AUDIO_QUALITY_TIERS:
+                        raise HTTPException(status_code=400, detail=f"Unknown audio quality: {quality}")
+                    style = message.get("style", "illustration")
+                    if style not in IMAGE_STYLES:
+                        raise HTTPException(status_code=400, detail=f"Unknown image style: {style}")
+                    await push({"type": "scene_media", **_request_scene_media(session_id, kinds, quality, style)})
+                except HTTPException as e:
+                    await push({"type": "error", "detail": e.detail})
+            else:
+                await push({"type": "error", "detail": f"Unknown message type: {message_type}"})
+        
+    except asyncio.TimeoutError:
+        # No message, not even a pong, within the heartbeat timeout
+        await _close_quietly(websocket, code=1001)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks + ([turn] if turn else []):
+            task.cancel()
+
+def _retrieve_result(task: asyncio.Task) -> None:
+    # Socket tasks end with the connection (often by WebSocketDisconnect); nothing is left to handle
+    if not task.cancelled():
+        task.exception()
+
+async def _close_quietly(websocket: WebSocket, code: int) -> None:
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
 
 @router.get("/session/{session_id}")
-async def get_session(session_id: str):
+async def get_session(session_id: str, request: Request, response: Response):
     """Get current session state"""
-    if session_id not in sessions_db:
+    session = sessions_db.get(session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    session = sessions_db[session_id]
+    etag = make_etag("session", session_id, session.get("version", 0))
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
+    
+    response.headers.update(cache_headers(etag))
     return {
         "session_id": session_id,
         "current_scene": session["current_scene"],
@@ -141,14 +459,20 @@ async def get_session(session_id: str):
     }
 
 @router.get("/session/{session_id}/history")
-async def get_session_history(session_id: str):
+async def get_session_history(session_id: str, request: Request, response: Response):
     """Get full session history"""
-    if session_id not in sessions_db:
+    session = sessions_db.get(session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
     
+    etag = make_etag("session_history", session_id, session.get("version", 0))
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
+    
+    response.headers.update(cache_headers(etag))
     return {
         "session_id": session_id,
-        "history": sessions_db[session_id]["story_history"]
+        "history": session["story_history"]
     }
 
 @router.delete("/session/{session_id}")
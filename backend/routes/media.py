@@ -1,62 +1,173 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Header, Query, Request
 from fastapi.responses import FileResponse
 import aiofiles
 import uuid
 import os
+from typing import Optional
 from models.schemas import AudioRequest, VisualRequest
-from services.audio_service import AudioService
+from services.audio_service import AudioService, narration_key
 from services.visual_service import VisualService
 from services.gemini_service import GeminiService
+from services.state_backend import state_backend
+from services.deadline import Deadline, ENDPOINT_DEADLINES
+from services.admission import Ticket, admission_controller
+from services.idempotency import idempotency_store, request_fingerprint
+from services.media_jobs import media_jobs
+from services.media_pipeline import MediaPipeline, STAGES as PIPELINE_STAGES
 
 router = APIRouter()
 audio_service = AudioService()
 visual_service = VisualService()
 gemini_service = GeminiService()
+media_pipeline = MediaPipeline(gemini_service, visual_service, audio_service, state_backend)
+
+def _start_media_job(background_tasks: BackgroundTasks, media_id: str, media_type: str, file_path: str, ticket: Ticket, generator, *args, **kwargs):
+    """Record a pending media job and schedule its generator in the background.
+
+    The admission ticket is held until the job finishes, so queued background
+    work counts against its provider.
+    """
+    media_jobs.start(media_id, media_type, file_path)
+    background_tasks.add_task(_run_media_job, media_id, ticket, generator, *args, **kwargs)
+
+async def _run_media_job(media_id: str, ticket: Ticket, generator, *args, **kwargs):
+    """Run a media generator and publish its outcome to the job table"""
+    try:
+        succeeded = await generator(*args, **kwargs)
+    except Exception as e:
+        print(f"Error in media job {media_id}: {str(e)}")
+        succeeded = False
+    finally:
+        ticket.release()
+    media_jobs.finish(media_id, succeeded)
+
+def _negotiate_audio_quality(request: Request, requested: Optional[str]) -> str:
+    """Use the requested tier, else pick one from Save-Data and network client hints.
+
+    Browsers send ECT and Downlink only because the frontend's pages request
+    them with Accept-CH and delegate them to the API origin.
+    """
+    if requested:
+        return requested
+    if request.headers.get("save-data", "").lower() == "on":
+        return "low"
+    if request.headers.get("ect", "").lower() in ("slow-2g", "2g", "3g"):
+        return "low"
+    try:
+        if float(request.headers.get("downlink", "")) < 1.5:
+            return "low"
+    except ValueError:
+        pass
+    return "standard"
+
+def _start_audio_variant(
+    background_tasks: BackgroundTasks,
+    text: str,
+    language,
+    voice_style: str,
+    accent: Optional[str],
+    quality: str
+):
+    """Schedule one quality variant of a narration unless it exists or is already being generated.
+
+    Variants are content addressed, so repeated requests for the same narration
+    and tier share a single file. Returns ``(audio_id, audio_url, status)``.
+    """
+    audio_id = f"{narration_key(text, language, voice_style, accent)}_{quality}"
+    audio_filename = f"audio_{audio_id}.mp3"
+    audio_path = f"static/audio/{audio_filename}"
+    audio_url = f"/static/audio/{audio_filename}"
+    
+    if os.path.exists(audio_path):
+        return audio_id, audio_url, "completed"
+    if media_jobs.generating(media_jobs.get(audio_id)):
+        return audio_id, audio_url, "generating"
+    
+    ticket = admission_controller.admit("elevenlabs")
+    if not media_jobs.claim(audio_id, "audio", audio_path):
+        ticket.release()
+        return audio_id, audio_url, "generating"
+    background_tasks.add_task(
+        _run_media_job,
+        audio_id,
+        ticket,
+        audio_service.generate_audio,
+        text,
+        audio_path,
+        language,
+        voice_style,
+        accent,
+        quality=quality
+    )
+    return audio_id, audio_url, "generating"
 
 @router.post("/generate-audio")
-async def generate_audio(audio_request: AudioRequest, background_tasks: BackgroundTasks):
+async def generate_audio(
+    audio_request: AudioRequest,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Generate audio narration for story content"""
     try:
-        audio_id = str(uuid.uuid4())
-        audio_filename = f"audio_{audio_id}.mp3"
-        audio_path = f"static/audio/{audio_filename}"
+        quality = _negotiate_audio_quality(request, audio_request.quality)
         
-        # Generate audio in background
-        background_tasks.add_task(
-            audio_service.generate_audio,
-            audio_request.text,
-            audio_path,
-            audio_request.language,
-            audio_request.voice_style,
-            audio_request.accent
-        )
+        async def start():
+            # Generate audio in background
+            audio_id, audio_url, status = _start_audio_variant(
+                background_tasks,
+                audio_request.text,
+                audio_request.language,
+                audio_request.voice_style,
+                audio_request.accent,
+                quality
+            )
+            
+            return {
+                "audio_id": audio_id,
+                "status": status,
+                "quality": quality,
+                "audio_url": audio_url,
+                "message": "Audio generation started. Check status endpoint for progress."
+            }
         
-        return {
-            "audio_id": audio_id,
-            "status": "generating",
-            "audio_url": f"/static/audio/{audio_filename}",
-            "message": "Audio generation started. Check status endpoint for progress."
-        }
+        return await idempotency_store.run(
+            "media.generate_audio",
+            idempotency_key,
+            request_fingerprint(audio_request),
+            start
+        )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating audio: {str(e)}")
 
 @router.post("/generate-visual")
 async def generate_visual(visual_request: VisualRequest, background_tasks: BackgroundTasks):
     """Generate visual content for story scenes"""
+    # Reserve the image slot before spending a Gemini call on the description
+    image_ticket = admission_controller.admit("stability")
     try:
         # First, enhance the description using Gemini
-        enhanced_description = await gemini_service.generate_visual_description(
-            visual_request.description,
-            visual_request.story_context
-        )
+        with admission_controller.admit("gemini"):
+            enhanced_description = await gemini_service.generate_visual_description(
+                visual_request.description,
+                visual_request.story_context,
+                Deadline.for_endpoint("visual")
+            )
         
         image_id = str(uuid.uuid4())
         image_filename = f"image_{image_id}.png"
         image_path = f"static/images/{image_filename}"
         
         # Generate image in background
-        background_tasks.add_task(
+        _start_media_job(
+            background_tasks,
+            image_id,
+            "image",
+            image_path,
+            image_ticket,
             visual_service.generate_image,
             enhanced_description,
             image_path,
@@ -71,7 +182,11 @@ async def generate_visual(visual_request: VisualRequest, background_tasks: Backg
             "message": "Image generation started. Check status endpoint for progress."
         }
         
+    except HTTPException:
+        image_ticket.release()
+        raise
     except Exception as e:
+        image_ticket.release()
         raise HTTPException(status_code=500, detail=f"Error generating visual: {str(e)}")
 
 @router.get("/audio/{filename}")
@@ -93,75 +208,83 @@ async def get_image(filename: str):
     return FileResponse(file_path, media_type="image/png")
 
 @router.post("/story/{story_id}/generate-complete-media")
-async def generate_complete_media(story_id: str, background_tasks: BackgroundTasks):
+async def generate_complete_media(
+    story_id: str,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    quality: Optional[str] = Query(None, pattern=r"^(low|standard|high)$"),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Generate both audio and visual content for a complete story"""
+    # Only explicit parameters are fingerprinted: a retry whose network hints changed
+    # is still the same request, and replays the tier negotiated the first time
+    fingerprint = request_fingerprint(story_id, quality)
+    quality = _negotiate_audio_quality(request, quality)
+    return await idempotency_store.run(
+        "media.generate_complete_media",
+        idempotency_key,
+        fingerprint,
+        lambda: _generate_complete_media(story_id, quality, background_tasks),
+        wait=ENDPOINT_DEADLINES["visual"]
+    )
+
+async def _generate_complete_media(story_id: str, quality: str, background_tasks: BackgroundTasks) -> dict:
+    from routes.stories import stories_db
+    
+    story = stories_db.get(story_id)
+    if story is None:
+        raise HTTPException(status_code=404, detail="Story not found")
+    
+    # Both branches are admitted up front so a rejection leaves nothing half started
+    visual_ticket = admission_controller.admit("gemini", "stability")
     try:
-        from routes.stories import stories_db
-        
-        if story_id not in stories_db:
-            raise HTTPException(status_code=404, detail="Story not found")
-        
-        story = stories_db[story_id]
-        
-        # Generate audio
-        audio_request = AudioRequest(
-            text=story["enhanced_content"],
-            language=story["language"],
-            voice_style="narrative"
-        )
-        
-        # Generate visual
-        visual_request = VisualRequest(
-            description=story["enhanced_content"][:200],
-            story_context=f"{story['culture']} {story['story_type']}",
-            style="illustration"
-        )
-        
-        # Generate both in background
-        audio_id = str(uuid.uuid4())
-        image_id = str(uuid.uuid4())
-        
-        audio_filename = f"story_audio_{audio_id}.mp3"
-        image_filename = f"story_image_{image_id}.png"
-        
-        background_tasks.add_task(
-            audio_service.generate_audio,
-            audio_request.text,
-            f"static/audio/{audio_filename}",
-            audio_request.language,
-            audio_request.voice_style
-        )
-        
-        enhanced_description = await gemini_service.generate_visual_description(
-            visual_request.description,
-            visual_request.story_context
-        )
-        
-        background_tasks.add_task(
-            visual_service.generate_image,
-            enhanced_description,
-            f"static/images/{image_filename}",
-            visual_request.style
-        )
-        
-        # Update story with media URLs
-        stories_db[story_id]["audio_url"] = f"/static/audio/{audio_filename}"
-        stories_db[story_id]["image_url"] = f"/static/images/{image_filename}"
+        audio_ticket = admission_controller.admit("elevenlabs")
+    except HTTPException:
+        visual_ticket.release()
+        raise
+    
+    try:
+        pipeline = media_pipeline.create(story, quality)
+        background_tasks.add_task(media_pipeline.run, pipeline["pipeline_id"], story, quality, visual_ticket, audio_ticket)
         
         return {
             "story_id": story_id,
-            "audio_url": f"/static/audio/{audio_filename}",
-            "image_url": f"/static/images/{image_filename}",
-            "status": "generating",
-            "message": "Media generation started for complete story"
+            "pipeline_id": pipeline["pipeline_id"],
+            "quality": quality,
+            "status": pipeline["status"],
+            "message": "Media pipeline started. Check the pipeline endpoint for progress."
         }
         
     except Exception as e:
+        visual_ticket.release()
+        audio_ticket.release()
         raise HTTPException(status_code=500, detail=f"Error generating complete media: {str(e)}")
 
+@router.get("/pipeline/{pipeline_id}")
+async def get_media_pipeline(pipeline_id: str):
+    """Progress and results of each stage of a story media pipeline"""
+    pipeline = media_pipeline.get(pipeline_id)
+    if pipeline is None:
+        raise HTTPException(status_code=404, detail="Pipeline not found")
+    
+    return {
+        "pipeline_id": pipeline_id,
+        "story_id": pipeline["story_id"],
+        "quality": pipeline["quality"],
+        "status": pipeline["status"],
+        "stages": {stage: pipeline[stage] for stage in PIPELINE_STAGES}
+    }
+
 @router.get("/status/{media_id}")
 async def get_media_status(media_id: str, media_type: str):
     """Check the status of media generation"""
+    job = media_jobs.get(media_id)
+    if job and job["media_type"] == media_type:
+        status = {"media_id": media_id, "status": job["status"]}
+        if job["status"] == "completed" and os.path.exists(job["file_path"]):
+            status["file_size"] = os.path.getsize(job["file_path"])
+        return status
+    
     if media_type == "audio":
         file_path = f"static/audio/audio_{media_id}.mp3"
     elif media_type == "image":
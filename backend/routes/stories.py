@@ -1,48 +1,164 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Header, Query, Request, Response
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from typing import List, Optional
 import uuid
 import json
+import hashlib
 import aiofiles
 from models.schemas import StoryInput, StoryResponse, Language, StoryType
 from services.gemini_service import GeminiService
+from services.state_backend import state_backend
+from services.serialization import json_response, make_etag, cache_headers, is_not_modified, not_modified_response
+from services.search_service import SearchService
+from services.similarity_service import SimilarityService
+from services.deadline import Deadline, ENDPOINT_DEADLINES
+from services.admission import admission_controller
+from services.idempotency import idempotency_store, request_fingerprint
 
 router = APIRouter()
 gemini_service = GeminiService()
 
-# In-memory storage (replace with database in production)
-stories_db = {}
+# Shared across workers through the configured state backend
+stories_db = state_backend.collection("stories", versioned=True)
+search_service = SearchService(stories_db)
+similarity_service = SimilarityService(state_backend)
+
+# Fields a listing can be projected onto, and the compact shape used by list views
+SUMMARY_SNIPPET_LENGTH = 200
+LISTABLE_FIELDS = set(StoryResponse.model_fields) | {"snippet"}
+
+def _story_summary(story: dict) -> dict:
+    """Compact representation of a story for list views"""
+    content = story.get("enhanced_content", "")
+    return {
+        "story_id": story["story_id"],
+        "title": story["title"],
+        "culture": story["culture"],
+        "story_type": story["story_type"],
+        "language": story["language"],
+        "snippet": content[:SUMMARY_SNIPPET_LENGTH],
+        "audio_url": story.get("audio_url"),
+        "image_url": story.get("image_url")
+    }
+
+def _project_story(story: dict, fields: List[str]) -> dict:
+    """Keep only the requested fields of a story (or story summary)"""
+    projected = {}
+    for field in fields:
+        if field == "snippet" and field not in story:
+            projected[field] = story.get("enhanced_content", "")[:SUMMARY_SNIPPET_LENGTH]
+        else:
+            projected[field] = story.get(field)
+    return projected
+
+def _parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Parse a comma separated ``fields`` query parameter"""
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in LISTABLE_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
 
 @router.post("/create", response_model=StoryResponse)
-async def create_story(story_input: StoryInput):
-    """Create a new enhanced story"""
+async def create_story(
+    story_input: StoryInput,
+    reuse_similar: bool = True,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Create a new enhanced story.
+
+    Near-duplicates of an existing story (same language, type and age group)
+    reuse its enhanced content, choices and media unless ``reuse_similar`` is off.
+    Retries carrying the same ``Idempotency-Key`` get the original story back.
+    """
+    return await idempotency_store.run(
+        "stories.create",
+        idempotency_key,
+        request_fingerprint(story_input, reuse_similar),
+        lambda: _create_story(story_input, reuse_similar),
+        wait=ENDPOINT_DEADLINES["create"]
+    )
+
+async def _enhance_with_choices(story_input: StoryInput):
+    """Enhanced text and opening choices, plus whether either fell back to generic content"""
+    deadline = Deadline.for_endpoint("create")
+    with admission_controller.admit("gemini"):
+        enhancement_result = await gemini_service.enhance_story(story_input, deadline)
+        try:
+            choices = await gemini_service.generate_interactive_choices(
+                enhancement_result["enhanced_content"],
+                deadline=deadline,
+                strict=True
+            )
+            degraded = not enhancement_result["success"]
+        except Exception as e:
+            print(f"Error generating choices: {str(e)}")
+            choices = gemini_service.fallback_choices()
+            degraded = True
+    return enhancement_result["enhanced_content"], choices, degraded
+
+def _is_degraded(story: dict) -> bool:
+    """Whether a stored story carries Gemini's generic fallback choices"""
+    fallback = [choice.choice_text for choice in gemini_service.fallback_choices()]
+    return [choice.get("choice_text") for choice in story.get("choices", [])] == fallback
+
+async def _create_story(story_input: StoryInput, reuse_similar: bool) -> StoryResponse:
     try:
         story_id = str(uuid.uuid4())
+        signature = await similarity_service.signature_async(story_input.content)
         
-        # Enhance the story using Gemini
-        enhancement_result = await gemini_service.enhance_story(story_input)
+        if reuse_similar:
+            match = await run_in_threadpool(similarity_service.find_duplicate, story_input, signature)
+            source = stories_db.get(match["story_id"]) if match else None
+            # Stories created during an outage may still be indexed; never copy their fallbacks
+            if source and not _is_degraded(source):
+                story_response = StoryResponse(
+                    story_id=story_id,
+                    title=story_input.title,
+                    enhanced_content=source["enhanced_content"],
+                    language=story_input.language,
+                    culture=story_input.culture,
+                    story_type=story_input.story_type,
+                    tags=story_input.tags,
+                    interactive_enabled=True,
+                    choices=source["choices"],
+                    audio_url=source.get("audio_url"),
+                    image_url=source.get("image_url"),
+                    derived_from=match["story_id"]
+                )
+                stories_db[story_id] = story_response.model_dump()
+                similarity_service.register(story_id, story_input, signature)
+                search_service.notify(story_id)
+                return story_response
         
-        # Generate initial interactive choices
-        choices = await gemini_service.generate_interactive_choices(
-            enhancement_result["enhanced_content"]
-        )
+        # Enhance the story using Gemini, both calls sharing the endpoint's deadline
+        enhanced_content, choices, degraded = await _enhance_with_choices(story_input)
         
         story_response = StoryResponse(
             story_id=story_id,
             title=story_input.title,
-            enhanced_content=enhancement_result["enhanced_content"],
+            enhanced_content=enhanced_content,
             language=story_input.language,
             culture=story_input.culture,
             story_type=story_input.story_type,
+            tags=story_input.tags,
             interactive_enabled=True,
             choices=choices
         )
         
-        # Store in database
+        # Store in database; only fully enhanced stories may be reused for near-duplicates
         stories_db[story_id] = story_response.model_dump()
+        if not degraded:
+            similarity_service.register(story_id, story_input, signature)
+        search_service.notify(story_id)
         
         return story_response
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating story: {str(e)}")
 
@@ -53,7 +169,8 @@ async def upload_story_file(
     story_type: StoryType = Form(...),
     language: Language = Form(Language.ENGLISH),
     culture: str = Form(...),
-    target_age_group: str = Form("all")
+    target_age_group: str = Form("all"),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """Upload story from text file"""
     try:
@@ -72,19 +189,40 @@ async def upload_story_file(
         )
         
         # Use the create_story function
-        return await create_story(story_input)
+        return await idempotency_store.run(
+            "stories.upload",
+            idempotency_key,
+            request_fingerprint(story_input.model_dump(exclude={"content"}), hashlib.sha256(content).hexdigest()),
+            lambda: _create_story(story_input, True),
+            wait=ENDPOINT_DEADLINES["create"]
+        )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error uploading story: {str(e)}")
 
 @router.get("/list")
 async def list_stories(
+    request: Request,
     language: Optional[Language] = None,
     story_type: Optional[StoryType] = None,
-    culture: Optional[str] = None
+    culture: Optional[str] = None,
+    fields: Optional[str] = None,
+    summary: bool = False
 ):
-    """List all stories with optional filtering"""
+    """List all stories with optional filtering.
+
+    ``summary=true`` returns the compact list-view shape and ``fields`` projects
+    each story onto a comma separated set of fields.
+    """
+    projection = _parse_fields(fields)
     try:
+        # The ETag follows the whole collection, so any story write invalidates every listing
+        etag = make_etag("stories", stories_db.version())
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+        
         stories = list(stories_db.values())
         
         # Apply filters
@@ -95,21 +233,58 @@ async def list_stories(
         if culture:
             stories = [s for s in stories if culture.lower() in s["culture"].lower()]
         
-        return {
+        if summary:
+            stories = [_story_summary(s) for s in stories]
+        if projection:
+            stories = [_project_story(s, projection) for s in stories]
+        
+        return json_response({
             "stories": stories,
             "total": len(stories)
-        }
+        }, headers=cache_headers(etag))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing stories: {str(e)}")
 
+@router.get("/search")
+async def search_stories(
+    q: str = Query(..., min_length=1),
+    language: Optional[Language] = None,
+    story_type: Optional[StoryType] = None,
+    culture: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100)
+):
+    """Full-text search over title, culture, tags and content, ranked by BM25"""
+    try:
+        results = []
+        # Catching up on the change log can take a while, so it stays off the event loop
+        for hit in await run_in_threadpool(search_service.search, q, language, story_type, culture, limit):
+            story = stories_db.get(hit["story_id"])
+            if story:
+                results.append({**_story_summary(story), "score": hit["score"]})
+        
+        return json_response({
+            "query": q,
+            "results": results,
+            "total": len(results)
+        })
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching stories: {str(e)}")
+
 @router.get("/{story_id}", response_model=StoryResponse)
-async def get_story(story_id: str):
+async def get_story(story_id: str, request: Request, response: Response):
     """Get a specific story by ID"""
-    if story_id not in stories_db:
+    story = stories_db.get(story_id)
+    if story is None:
         raise HTTPException(status_code=404, detail="Story not found")
     
-    return StoryResponse(**stories_db[story_id])
+    etag = make_etag("story", story_id, story.get("version", 0))
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
+    
+    response.headers.update(cache_headers(etag))
+    return StoryResponse(**story)
 
 @router.post("/{story_id}/translate")
 async def translate_story(story_id: str, target_language: Language):
@@ -119,10 +294,12 @@ async def translate_story(story_id: str, target_language: Language):
     
     try:
         story = stories_db[story_id]
-        translated_content = await gemini_service.translate_story(
-            story["enhanced_content"], 
-            target_language
-        )
+        with admission_controller.admit("gemini"):
+            translated_content = await gemini_service.translate_story(
+                story["enhanced_content"], 
+                target_language,
+                Deadline.for_endpoint("translate")
+            )
         
         # Create new story with translation
         new_story_id = str(uuid.uuid4())
@@ -134,9 +311,12 @@ async def translate_story(story_id: str, target_language: Language):
         })
         
         stories_db[new_story_id] = translated_story
+        search_service.notify(new_story_id)
         
         return StoryResponse(**translated_story)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error translating story: {str(e)}")
 
@@ -146,7 +326,11 @@ async def delete_story(story_id: str):
     if story_id not in stories_db:
         raise HTTPException(status_code=404, detail="Story not found")
     
+    from routes.interactive import story_compiler
     del stories_db[story_id]
+    story_compiler.invalidate(story_id)
+    similarity_service.remove(story_id)
+    search_service.notify(story_id)
     return {"message": "Story deleted successfully"}
 
 @router.put("/{story_id}")
@@ -157,24 +341,32 @@ async def update_story(story_id: str, story_input: StoryInput):
     
     try:
         # Re-enhance the updated story
-        enhancement_result = await gemini_service.enhance_story(story_input)
-        choices = await gemini_service.generate_interactive_choices(
-            enhancement_result["enhanced_content"]
-        )
+        enhanced_content, choices, degraded = await _enhance_with_choices(story_input)
         
         updated_story = StoryResponse(
             story_id=story_id,
             title=story_input.title,
-            enhanced_content=enhancement_result["enhanced_content"],
+            enhanced_content=enhanced_content,
             language=story_input.language,
             culture=story_input.culture,
             story_type=story_input.story_type,
+            tags=story_input.tags,
             interactive_enabled=True,
             choices=choices
         )
         
+        from routes.interactive import story_compiler
         stories_db[story_id] = updated_story.model_dump()
+        # The compiled choice tree was built from the previous text
+        story_compiler.invalidate(story_id)
+        if degraded:
+            similarity_service.remove(story_id)
+        else:
+            similarity_service.register(story_id, story_input, await similarity_service.signature_async(story_input.content))
+        search_service.notify(story_id)
         return updated_story
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error updating story: {str(e)}")
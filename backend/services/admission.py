@@ -0,0 +1,172 @@
+import math
+import os
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+from decouple import config
+from fastapi import HTTPException
+from services.deadline import latency_trackers
+from services.state_backend import StateBackend, state_backend
+
+# Concurrent requests each provider can serve before new work starts queueing,
+# and the service time assumed until real latencies have been observed
+PROVIDER_LIMITS = {
+    "gemini": {
+        "capacity": config('GEMINI_CAPACITY', default=16, cast=int),
+        "default_latency": config('GEMINI_DEFAULT_LATENCY', default=5.0, cast=float),
+    },
+    "elevenlabs": {
+        "capacity": config('ELEVENLABS_CAPACITY', default=4, cast=int),
+        "default_latency": config('ELEVENLABS_DEFAULT_LATENCY', default=15.0, cast=float),
+    },
+    "stability": {
+        "capacity": config('STABILITY_CAPACITY', default=4, cast=int),
+        "default_latency": config('STABILITY_DEFAULT_LATENCY', default=10.0, cast=float),
+    },
+}
+
+# Requests whose projected queueing delay exceeds this are rejected up front
+ADMISSION_MAX_WAIT = config('ADMISSION_MAX_WAIT', default=10.0, cast=float)
+
+# Each worker's outstanding counts live in one row of this namespace. A row not
+# touched for this long belongs to a worker that died holding requests, and is
+# ignored; it must outlast the longest provider-bound request.
+ADMISSION_NAMESPACE = "admission"
+ADMISSION_STALE_SECONDS = config('ADMISSION_STALE_SECONDS', default=600, cast=int)
+
+
+class Ticket:
+    """Admission for one request; release it once the request's provider work is done"""
+
+    def __init__(self, controller: "AdmissionController", providers: List[str]):
+        self.controller = controller
+        self.providers = providers
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.controller._release(self.providers)
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class AdmissionController:
+    """Sheds provider-bound requests the providers could not start in time.
+
+    Each admitted request counts against the providers it will call until its
+    ticket is released. Counts are kept in the shared state backend, one row
+    per worker, so capacities apply to the whole deployment rather than to
+    each worker. A new request is rejected with 503 and Retry-After when the
+    work already ahead of it would keep it waiting longer than
+    ``ADMISSION_MAX_WAIT``.
+    """
+
+    def __init__(
+        self,
+        backend: StateBackend = state_backend,
+        limits: Dict[str, dict] = PROVIDER_LIMITS,
+        max_wait: float = ADMISSION_MAX_WAIT
+    ):
+        self.backend = backend
+        self.limits = limits
+        self.max_wait = max_wait
+        self.rejected = {provider: 0 for provider in limits}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _worker() -> str:
+        # Looked up per call: the controller is built before uvicorn forks its workers
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _count(self, providers: List[str], amount: int) -> None:
+        worker = self._worker()
+        fields = {"heartbeat": time.time()}
+        increments = {provider: amount for provider in providers}
+        if self.backend.update(ADMISSION_NAMESPACE, worker, fields, increments=increments) is None:
+            self.backend.add(ADMISSION_NAMESPACE, worker, {provider: 0 for provider in self.limits})
+            self.backend.update(ADMISSION_NAMESPACE, worker, fields, increments=increments)
+
+    def outstanding(self) -> Dict[str, int]:
+        """Requests admitted and not yet released, summed across live workers"""
+        totals = {provider: 0 for provider in self.limits}
+        cutoff = time.time() - ADMISSION_STALE_SECONDS
+        for row in self.backend.values(ADMISSION_NAMESPACE):
+            if row.get("heartbeat", 0) < cutoff:
+                continue
+            for provider in totals:
+                totals[provider] += max(0, row.get(provider, 0))
+        return totals
+
+    def reset_worker(self) -> None:
+        """Drop this worker's row; run at startup, in case a dead worker with the same pid left one, and at shutdown"""
+        self.backend.delete(ADMISSION_NAMESPACE, self._worker())
+
+    def service_time(self, provider: str) -> float:
+        """Mean observed latency across the provider's models"""
+        samples = [
+            tracker.mean() for name, tracker in list(latency_trackers.items())
+            if name.split(":")[0] == provider
+        ]
+        samples = [sample for sample in samples if sample is not None]
+        return sum(samples) / len(samples) if samples else self.limits[provider]["default_latency"]
+
+    def projected_wait(self, provider: str, outstanding: Optional[int] = None) -> float:
+        """Seconds a request admitted now would queue before the provider starts on it"""
+        capacity = self.limits[provider]["capacity"]
+        if outstanding is None:
+            outstanding = self.outstanding()[provider]
+        ahead = outstanding - capacity + 1
+        if ahead <= 0:
+            return 0.0
+        return math.ceil(ahead / capacity) * self.service_time(provider)
+
+    def admit(self, *providers: str) -> Ticket:
+        # Count the request first and judge it by what is ahead of it, so two
+        # workers admitting at once both see each other rather than both slipping in
+        self._count(list(providers), 1)
+        outstanding = self.outstanding()
+        for provider in providers:
+            wait = self.projected_wait(provider, outstanding[provider] - 1)
+            if wait > self.max_wait:
+                self._count(list(providers), -1)
+                with self._lock:
+                    self.rejected[provider] += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail=f"{provider} is at capacity, please retry later",
+                    headers={"Retry-After": str(max(1, math.ceil(wait - self.max_wait)))}
+                )
+        return Ticket(self, list(providers))
+
+    def track(self, *providers: str) -> Ticket:
+        """Count a request against its providers without ever rejecting it.
+
+        For latency-critical calls that already degrade to fallbacks, so their
+        load still shows in the projected wait other requests are admitted by.
+        """
+        self._count(list(providers), 1)
+        return Ticket(self, list(providers))
+
+    def _release(self, providers: List[str]) -> None:
+        self._count(providers, -1)
+
+    def snapshot(self) -> Dict[str, dict]:
+        outstanding = self.outstanding()
+        return {
+            provider: {
+                "outstanding": outstanding[provider],
+                "capacity": self.limits[provider]["capacity"],
+                "projected_wait": round(self.projected_wait(provider, outstanding[provider]), 2),
+                "rejected": self.rejected[provider]
+            }
+            for provider in self.limits
+        }
+
+
+admission_controller = AdmissionController()
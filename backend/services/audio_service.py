@@ -1,11 +1,44 @@
-from elevenlabs import generate, set_api_key, Voice, VoiceSettings
+from elevenlabs import set_api_key, Voice, VoiceSettings
+from elevenlabs.api.base import API, api_base_url_v1
 from decouple import config
 import aiofiles
+import hashlib
+import json
+import os
+import uuid
+from typing import Optional
 from models.schemas import Language
+from services.deadline import Deadline, call_with_deadline
+
+# ElevenLabs output format per bandwidth tier; all tiers are MP3 so clients need no extra codecs
+AUDIO_QUALITY_TIERS = {
+    "low": "mp3_22050_32",
+    "standard": "mp3_44100_128",
+    "high": "mp3_44100_192",
+}
+
+def narration_key(text: str, language: Language, voice_style: str, accent: Optional[str] = None) -> str:
+    """Stable id for a narration, shared by every quality variant of it"""
+    payload = json.dumps([text, language, voice_style, accent], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
 
 class AudioService:
     def __init__(self):
         set_api_key(config('ELEVENLABS_API_KEY', default=''))
+
+    def _synthesize(self, text: str, voice: Voice, model: str, output_format: str, timeout: float) -> bytes:
+        """Text-to-speech request with an explicit output format.
+
+        ``timeout`` bounds the HTTP request itself, so a hung call gives its
+        provider thread back instead of holding it past the caller's deadline.
+        """
+        url = f"{api_base_url_v1}/text-to-speech/{voice.voice_id}?output_format={output_format}"
+        data = dict(
+            text=text,
+            model_id=model,
+            voice_settings=voice.settings.model_dump() if voice.settings else None
+        )
+        return API.post(url, json=data, timeout=timeout).content
         
     async def generate_audio(
         self, 
@@ -13,7 +46,9 @@ class AudioService:
         output_path: str, 
         language: Language = Language.ENGLISH,
         voice_style: str = "narrative",
-        accent: str = None
+        accent: str = None,
+        deadline: Optional[Deadline] = None,
+        quality: str = "standard"
     ):
         """Generate audio narration with emotion and cultural authenticity"""
         try:
@@ -46,18 +81,31 @@ class AudioService:
             )
             
             # Generate audio
-            audio = generate(
-                text=text,
-                voice=Voice(
+            model = "eleven_multilingual_v2" if language != Language.ENGLISH else "eleven_monolingual_v1"
+            deadline = deadline or Deadline.for_endpoint("audio")
+            audio = await call_with_deadline(
+                f"elevenlabs:{model}",
+                self._synthesize,
+                text,
+                Voice(
                     voice_id="JBFqnCBsd6RMkjVDRZzb",
                     settings=voice_settings
                 ),
-                model="eleven_multilingual_v2" if language != Language.ENGLISH else "eleven_monolingual_v1"
+                model,
+                AUDIO_QUALITY_TIERS.get(quality, AUDIO_QUALITY_TIERS["standard"]),
+                deadline.remaining(),
+                deadline=deadline
             )
             
-            # Save audio file
-            async with aiofiles.open(output_path, 'wb') as f:
-                await f.write(audio)
+            # Save audio file under a temporary name, so a half-written file is never served
+            temp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+            try:
+                async with aiofiles.open(temp_path, 'wb') as f:
+                    await f.write(audio)
+                os.replace(temp_path, output_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
                 
             return True
             
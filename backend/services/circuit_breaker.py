@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import deque
+from typing import Dict
+from decouple import config
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+BREAKER_WINDOW = config('BREAKER_WINDOW', default=20, cast=int)
+BREAKER_MIN_CALLS = config('BREAKER_MIN_CALLS', default=5, cast=int)
+BREAKER_FAILURE_RATE = config('BREAKER_FAILURE_RATE', default=0.5, cast=float)
+BREAKER_SLOW_CALL_SECONDS = config('BREAKER_SLOW_CALL_SECONDS', default=15.0, cast=float)
+# What counts as slow depends on the provider: narration and images legitimately take longer
+PROVIDER_SLOW_CALL_SECONDS = {
+    "gemini": config('GEMINI_SLOW_CALL_SECONDS', default=BREAKER_SLOW_CALL_SECONDS, cast=float),
+    "elevenlabs": config('ELEVENLABS_SLOW_CALL_SECONDS', default=45.0, cast=float),
+    "stability": config('STABILITY_SLOW_CALL_SECONDS', default=30.0, cast=float),
+}
+BREAKER_SLOW_CALL_RATE = config('BREAKER_SLOW_CALL_RATE', default=0.8, cast=float)
+BREAKER_OPEN_SECONDS = config('BREAKER_OPEN_SECONDS', default=30.0, cast=float)
+BREAKER_HALF_OPEN_CALLS = config('BREAKER_HALF_OPEN_CALLS', default=1, cast=int)
+# A half-open probe that has reported nothing for this long no longer holds its slot
+BREAKER_PROBE_TIMEOUT = config('BREAKER_PROBE_TIMEOUT', default=90.0, cast=float)
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a provider whose breaker is open"""
+
+
+class CircuitBreaker:
+    """Tracks the outcome of recent calls to one provider model.
+
+    The breaker opens when the failure rate or the slow-call rate over the last
+    ``window`` calls crosses its threshold. After ``open_seconds`` it lets a few
+    probe calls through (half-open) and closes again once they succeed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window: int = BREAKER_WINDOW,
+        min_calls: int = BREAKER_MIN_CALLS,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        slow_call_seconds: float = BREAKER_SLOW_CALL_SECONDS,
+        slow_call_rate: float = BREAKER_SLOW_CALL_RATE,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+        half_open_calls: int = BREAKER_HALF_OPEN_CALLS,
+        probe_timeout: float = BREAKER_PROBE_TIMEOUT
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.probe_timeout = probe_timeout
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._calls = deque(maxlen=window)  # (failed, slow) per call
+        self._probes = deque()  # start times of half-open probes still in flight
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self._probes.clear()
+            if self.state == HALF_OPEN:
+                now = time.monotonic()
+                while self._probes and now - self._probes[0] > self.probe_timeout:
+                    self._probes.popleft()
+                if len(self._probes) >= self.half_open_calls:
+                    return False
+                self._probes.append(now)
+            return True
+
+    def record_success(self, seconds: float) -> None:
+        self._record(failed=False, slow=seconds >= self.slow_call_seconds)
+
+    def record_failure(self) -> None:
+        self._record(failed=True, slow=False)
+
+    def record_abandoned(self) -> None:
+        """A call ended without an outcome (e.g. cancelled); free its probe slot without counting it"""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes:
+                self._probes.popleft()
+
+    def _record(self, failed: bool, slow: bool) -> None:
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if self._probes:
+                    self._probes.popleft()
+                if failed or slow:
+                    self._trip()
+                else:
+                    self.state = CLOSED
+                    self._calls.clear()
+                return
+
+            self._calls.append((failed, slow))
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for f, _ in self._calls if f)
+            slow_calls = sum(1 for _, s in self._calls if s)
+            if (
+                failures / len(self._calls) >= self.failure_rate
+                or slow_calls / len(self._calls) >= self.slow_call_rate
+            ):
+                self._trip()
+
+    def _trip(self) -> None:
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._calls.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            calls = len(self._calls)
+            return {
+                "state": self.state,
+                "recent_calls": calls,
+                "failure_rate": round(sum(1 for f, _ in self._calls if f) / calls, 3) if calls else 0.0,
+                "slow_call_rate": round(sum(1 for _, s in self._calls if s) / calls, 3) if calls else 0.0,
+                "retry_in": round(max(0.0, self.opened_at + self.open_seconds - time.monotonic()), 1)
+                if self.state == OPEN else 0.0
+            }
+
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+_registry_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    with _registry_lock:
+        if name not in circuit_breakers:
+            provider = name.split(":")[0]
+            circuit_breakers[name] = CircuitBreaker(
+                name,
+                slow_call_seconds=PROVIDER_SLOW_CALL_SECONDS.get(provider, BREAKER_SLOW_CALL_SECONDS)
+            )
+        return circuit_breakers[name]
+
+
+def circuit_breaker_states() -> Dict[str, dict]:
+    """State of every breaker in this worker, for health output"""
+    return {name: breaker.snapshot() for name, breaker in list(circuit_breakers.items())}
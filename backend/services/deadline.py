@@ -0,0 +1,250 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, Optional
+from decouple import config
+from services.circuit_breaker import CircuitOpenError, get_circuit_breaker
+
+# Latency budgets in seconds for each endpoint, shared by every provider call it makes
+ENDPOINT_DEADLINES = {
+    "create": config('DEADLINE_CREATE', default=25.0, cast=float),
+    "translate": config('DEADLINE_TRANSLATE', default=20.0, cast=float),
+    "choose": config('DEADLINE_CHOOSE', default=10.0, cast=float),
+    "visual": config('DEADLINE_VISUAL', default=10.0, cast=float),
+    "audio": config('DEADLINE_AUDIO', default=60.0, cast=float),
+    "image": config('DEADLINE_IMAGE', default=45.0, cast=float),
+}
+
+# Upper bound for provider calls made without an explicit deadline
+DEFAULT_PROVIDER_TIMEOUT = config('DEFAULT_PROVIDER_TIMEOUT', default=30.0, cast=float)
+
+HEDGE_ENABLED = config('HEDGE_ENABLED', default=True, cast=bool)
+HEDGE_PERCENTILE = config('HEDGE_PERCENTILE', default=95.0, cast=float)
+# Hedging only kicks in once a provider has enough latency samples to trust the percentile
+HEDGE_MIN_SAMPLES = 20
+
+# Blocking SDK calls run in a thread pool per provider rather than the loop's default
+# executor. Calls abandoned after a deadline keep their thread until the SDK returns,
+# and the Gemini SDK has no transport timeout, so a stalled provider can only exhaust
+# its own pool, never the threads TTS or image calls need
+PROVIDER_THREADS = {
+    "gemini": config('GEMINI_THREADS', default=32, cast=int),
+    "elevenlabs": config('ELEVENLABS_THREADS', default=16, cast=int),
+    "stability": config('STABILITY_THREADS', default=16, cast=int),
+}
+DEFAULT_PROVIDER_THREADS = config('PROVIDER_THREADS', default=16, cast=int)
+
+provider_executors: Dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_provider_executor(provider: str) -> ThreadPoolExecutor:
+    """Thread pool for a provider, shared by all of its models"""
+    name = provider.split(":")[0]
+    with _executors_lock:
+        if name not in provider_executors:
+            provider_executors[name] = ThreadPoolExecutor(
+                max_workers=PROVIDER_THREADS.get(name, DEFAULT_PROVIDER_THREADS),
+                thread_name_prefix=name
+            )
+        return provider_executors[name]
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """A provider call did not finish within the caller's deadline"""
+
+
+class Deadline:
+    """Absolute point in time by which a request must have finished"""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def for_endpoint(cls, endpoint: str) -> "Deadline":
+        return cls(ENDPOINT_DEADLINES[endpoint])
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+class LatencyTracker:
+    """Sliding window of recent successful call latencies for one provider"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
+
+    def mean(self) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            return sum(self._samples) / len(self._samples)
+
+
+latency_trackers: Dict[str, LatencyTracker] = {}
+
+
+def get_latency_tracker(provider: str) -> LatencyTracker:
+    if provider not in latency_trackers:
+        latency_trackers[provider] = LatencyTracker()
+    return latency_trackers[provider]
+
+
+async def call_with_deadline(
+    provider: str,
+    func: Callable,
+    *args,
+    deadline: Optional[Deadline] = None,
+    hedge: bool = False,
+    **kwargs
+):
+    """Run a blocking provider call off the event loop, bounded by ``deadline``.
+
+    ``provider`` names the provider model (e.g. ``"gemini:gemini-2.0-flash-exp"``)
+    and keys both its latency tracker and its circuit breaker. While the breaker
+    is open the call fails immediately with ``CircuitOpenError``.
+
+    With ``hedge`` set, a second identical call is started once the first has
+    been running longer than the provider's hedge percentile; whichever finishes
+    first wins and the other is abandoned. Raises ``DeadlineExceeded`` when the
+    deadline passes so callers can fall back immediately.
+    """
+    deadline = deadline or Deadline(DEFAULT_PROVIDER_TIMEOUT)
+    tracker = get_latency_tracker(provider)
+    started = time.monotonic()
+
+    if deadline.expired:
+        raise DeadlineExceeded(f"{provider} call skipped, deadline already passed")
+
+    breaker = get_circuit_breaker(provider)
+    if not breaker.allow_request():
+        raise CircuitOpenError(f"{provider} circuit is open")
+
+    try:
+        result = await _call_hedged(provider, tracker, deadline, hedge, functools.partial(func, *args, **kwargs))
+    except Exception:
+        breaker.record_failure()
+        raise
+    except BaseException:
+        # Cancelled before an outcome; a half-open probe must still give back its slot
+        breaker.record_abandoned()
+        raise
+    elapsed = time.monotonic() - started
+    tracker.record(elapsed)
+    breaker.record_success(elapsed)
+    return result
+
+
+async def _call_hedged(provider: str, tracker: LatencyTracker, deadline: Deadline, hedge: bool, call: Callable):
+    loop = asyncio.get_running_loop()
+    executor = get_provider_executor(provider)
+    attempts = [loop.run_in_executor(executor, call)]
+    try:
+        hedge_after = tracker.percentile(HEDGE_PERCENTILE) if hedge and HEDGE_ENABLED else None
+        if hedge_after is not None and hedge_after < deadline.remaining():
+            done, _ = await asyncio.wait(attempts, timeout=hedge_after)
+            if not done:
+                attempts.append(loop.run_in_executor(executor, call))
+
+        pending = set(attempts)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                raise DeadlineExceeded(f"{provider} call exceeded its deadline")
+            for attempt in done:
+                if attempt.exception() is None:
+                    return attempt.result()
+            if not pending:
+                raise next(iter(done)).exception()
+    finally:
+        for attempt in attempts:
+            # Threads cannot be interrupted; the losing call's result is simply dropped
+            attempt.cancel()
+
+
+async def stream_with_deadline(
+    provider: str,
+    func: Callable,
+    *args,
+    deadline: Optional[Deadline] = None,
+    **kwargs
+) -> AsyncIterator:
+    """Iterate a blocking streaming provider call off the event loop.
+
+    ``func`` must return an iterator; its items are yielded as they arrive. The
+    deadline bounds the whole stream and the provider's circuit breaker applies
+    exactly as in ``call_with_deadline``.
+    """
+    deadline = deadline or Deadline(DEFAULT_PROVIDER_TIMEOUT)
+    if deadline.expired:
+        raise DeadlineExceeded(f"{provider} stream skipped, deadline already passed")
+
+    breaker = get_circuit_breaker(provider)
+    if not breaker.allow_request():
+        raise CircuitOpenError(f"{provider} circuit is open")
+
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue()
+    finished = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in func(*args, **kwargs):
+                if stop.is_set():
+                    return
+                loop.call_soon_threadsafe(items.put_nowait, item)
+            loop.call_soon_threadsafe(items.put_nowait, finished)
+        except Exception as e:
+            if not stop.is_set():
+                loop.call_soon_threadsafe(items.put_nowait, e)
+
+    started = time.monotonic()
+    loop.run_in_executor(get_provider_executor(provider), produce)
+    outcome = None
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(items.get(), timeout=deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"{provider} stream exceeded its deadline")
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        outcome = "success"
+    except Exception:
+        outcome = "failure"
+        raise
+    finally:
+        stop.set()
+        # Cancellation and early close (GeneratorExit) reach only this block
+        if outcome == "success":
+            breaker.record_success(time.monotonic() - started)
+        elif outcome == "failure":
+            breaker.record_failure()
+        else:
+            breaker.record_abandoned()
@@ -1,15 +1,36 @@
 import google.generativeai as genai
 from decouple import config
-from typing import List, Dict, Any
+from typing import AsyncIterator, List, Dict, Any, Optional
 import json
 from models.schemas import StoryInput, InteractiveChoice, Language
+from services.deadline import Deadline, call_with_deadline, stream_with_deadline
 
 class GeminiService:
     def __init__(self):
         genai.configure(api_key=config('GEMINI_API_KEY'))
-        self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        self.model_name = 'gemini-2.0-flash-exp'
+        self.model = genai.GenerativeModel(self.model_name)
+
+    async def _generate(self, prompt: str, deadline: Optional[Deadline] = None):
+        """Call Gemini off the event loop, hedged and bounded by the caller's deadline"""
+        return await call_with_deadline(
+            f"gemini:{self.model_name}", self.model.generate_content, prompt, deadline=deadline, hedge=True
+        )
+
+    @staticmethod
+    def _strip_fences(text: str) -> str:
+        """Remove a markdown code block wrapped around a response, if present"""
+        text = text.strip()
+        if text.startswith('```'):
+            text = text[text.find('\n')+1:text.rfind('```')].strip()
+        return text
+
+    def _stream_texts(self, prompt: str):
+        for chunk in self.model.generate_content(prompt, stream=True):
+            if chunk.text:
+                yield chunk.text
         
-    async def enhance_story(self, story_input: StoryInput) -> Dict[str, Any]:
+    async def enhance_story(self, story_input: StoryInput, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """Enhance the original story with cultural context and better narrative"""
         print("Enhancing story with Gemini model...")
         print(f"Story Input: {story_input}")
@@ -37,7 +58,7 @@ class GeminiService:
         """
         
         try:
-            response = self.model.generate_content(prompt)
+            response = await self._generate(prompt, deadline)
             return {
                 "enhanced_content": response.text,
                 "success": True
@@ -49,8 +70,17 @@ class GeminiService:
                 "error": str(e)
             }
 
-    async def generate_interactive_choices(self, story_content: str, current_scene: str = None) -> List[InteractiveChoice]:
-        """Generate interactive choices for choose-your-own-adventure style storytelling"""
+    async def generate_interactive_choices(
+        self,
+        story_content: str,
+        current_scene: str = None,
+        deadline: Optional[Deadline] = None,
+        strict: bool = False
+    ) -> List[InteractiveChoice]:
+        """Generate interactive choices for choose-your-own-adventure style storytelling.
+
+        With ``strict`` set, errors are raised instead of returning generic fallback choices.
+        """
         scene_context = current_scene if current_scene else story_content[:500]
         
         prompt = f"""
@@ -73,70 +103,103 @@ class GeminiService:
         """
         
         try:
-            response = self.model.generate_content(prompt)
-            choices_data = json.loads(response.text)
+            response = await self._generate(prompt, deadline)
+            choices_data = json.loads(self._strip_fences(response.text))
             return [InteractiveChoice(**choice) for choice in choices_data]
         except Exception as e:
-            # Fallback choices
-            return [
-                InteractiveChoice(
-                    choice_id="choice_1",
-                    choice_text="Continue with the traditional path",
-                    consequence="The story follows its original course"
-                ),
-                InteractiveChoice(
-                    choice_id="choice_2",
-                    choice_text="Explore a different perspective",
-                    consequence="The story takes an alternative direction"
-                ),
-                InteractiveChoice(
-                    choice_id="choice_3",
-                    choice_text="Ask the elder for wisdom",
-                    consequence="Gain deeper cultural insights"
-                )
-            ]
-
-    async def continue_interactive_story(self, story_history: List[str], chosen_path: str) -> str:
-        """Continue the story based on user's choice"""
+            if strict:
+                raise
+            return self.fallback_choices()
+
+    @staticmethod
+    def fallback_choices() -> List[InteractiveChoice]:
+        """Generic choices offered when Gemini cannot generate any"""
+        return [
+            InteractiveChoice(
+                choice_id="choice_1",
+                choice_text="Continue with the traditional path",
+                consequence="The story follows its original course"
+            ),
+            InteractiveChoice(
+                choice_id="choice_2",
+                choice_text="Explore a different perspective",
+                consequence="The story takes an alternative direction"
+            ),
+            InteractiveChoice(
+                choice_id="choice_3",
+                choice_text="Ask the elder for wisdom",
+                consequence="Gain deeper cultural insights"
+            )
+        ]
+
+    def _continuation_prompt(self, story_history: List[str], chosen_path: str) -> str:
+        # Get the last few story segments for context
+        context = "\n".join(story_history[-3:])  # Use last 3 segments for context
+        
+        return f"""
+        Story so far:
+        {context}
+        
+        The reader chose: "{chosen_path}"
+        
+        Continue the story in 2-3 engaging paragraphs that:
+        1. Acknowledge the choice
+        2. Develop the story naturally
+        3. End with a new situation or decision point
+        4. Maintain cultural authenticity
+        
+        Write in a narrative style that matches the story's tone.
+        """
+
+    def _continuation_fallback(self, chosen_path: str) -> str:
+        return f"The story continues as you chose: {chosen_path}. The narrative unfolds in unexpected ways, leading to new adventures and challenges."
+
+    async def continue_interactive_story(
+        self,
+        story_history: List[str],
+        chosen_path: str,
+        deadline: Optional[Deadline] = None,
+        strict: bool = False
+    ) -> str:
+        """Continue the story based on user's choice.
+
+        With ``strict`` set, errors are raised instead of returning a fallback continuation.
+        """
         try:
-            # Get the last few story segments for context
-            context = "\n".join(story_history[-3:])  # Use last 3 segments for context
-            
-            prompt = f"""
-            Story so far:
-            {context}
-            
-            The reader chose: "{chosen_path}"
-            
-            Continue the story in 2-3 engaging paragraphs that:
-            1. Acknowledge the choice
-            2. Develop the story naturally
-            3. End with a new situation or decision point
-            4. Maintain cultural authenticity
-            
-            Write in a narrative style that matches the story's tone.
-            """
+            prompt = self._continuation_prompt(story_history, chosen_path)
             
-            response = self.model.generate_content(prompt)
+            response = await self._generate(prompt, deadline)
             
             if not hasattr(response, 'text') or not response.text.strip():
                 raise ValueError("Empty response from model")
                 
-            # Clean up the response
-            continuation = response.text.strip()
-            
-            # Remove any markdown code blocks if present
-            if continuation.startswith('```'):
-                continuation = continuation[continuation.find('\n')+1:continuation.rfind('```')].strip()
-                
-            return continuation
+            # Clean up the response, removing any markdown code blocks
+            return self._strip_fences(response.text)
             
         except Exception as e:
             print(f"Error continuing story: {str(e)}")
+            if strict:
+                raise
             # Return a fallback continuation
-            return f"The story continues as you chose: {chosen_path}. The narrative unfolds in unexpected ways, leading to new adventures and challenges."
+            return self._continuation_fallback(chosen_path)
 
-    async def translate_story(self, content: str, target_language: Language) -> str:
+    async def stream_interactive_story(self, story_history: List[str], chosen_path: str, deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+        """Continue the story like ``continue_interactive_story``, yielding text as it is generated"""
+        emitted = False
+        try:
+            prompt = self._continuation_prompt(story_history, chosen_path)
+            async for text in stream_with_deadline(
+                f"gemini:{self.model_name}", self._stream_texts, prompt, deadline=deadline
+            ):
+                emitted = True
+                yield text
+        except Exception as e:
+            print(f"Error streaming story: {str(e)}")
+            # Fall back only if the reader has not seen any of the scene yet
+            if not emitted:
+                yield self._continuation_fallback(chosen_path)
+
+    async def translate_story(self, content: str, target_language: Language, deadline: Optional[Deadline] = None) -> str:
         """Translate story content while preserving cultural context"""
         language_map = {
             Language.ENGLISH: "English",
@@ -159,13 +222,22 @@ class GeminiService:
         """
         
         try:
-            response = self.model.generate_content(prompt)
+            response = await self._generate(prompt, deadline)
             return response.text
         except Exception as e:
             return content
 
-    async def generate_visual_description(self, story_content: str, scene_context: str = None) -> str:
-        """Generate detailed visual descriptions for image generation"""
+    async def generate_visual_description(
+        self,
+        story_content: str,
+        scene_context: str = None,
+        deadline: Optional[Deadline] = None,
+        strict: bool = False
+    ) -> str:
+        """Generate detailed visual descriptions for image generation.
+
+        With ``strict`` set, errors are raised instead of returning a generic description.
+        """
         context = scene_context if scene_context else story_content[:300]
         
         prompt = f"""
@@ -182,7 +254,9 @@ class GeminiService:
         """
         
         try:
-            response = self.model.generate_content(prompt)
+            response = await self._generate(prompt, deadline)
             return response.text
         except Exception as e:
+            if strict:
+                raise
             return f"A cultural scene depicting {context}"
@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, Awaitable, Callable, Optional
+from decouple import config
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from services.serialization import json_response
+from services.state_backend import StateBackend, state_backend
+
+IDEMPOTENCY_NAMESPACE = "idempotency_keys"
+# Completed responses are replayed for this long after the original request
+IDEMPOTENCY_TTL = config('IDEMPOTENCY_TTL', default=86400, cast=int)
+# An in-progress claim older than this is assumed abandoned by a crashed worker
+IDEMPOTENCY_LOCK_SECONDS = config('IDEMPOTENCY_LOCK_SECONDS', default=120, cast=int)
+IDEMPOTENCY_MAX_KEYS = config('IDEMPOTENCY_MAX_KEYS', default=10000, cast=int)
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+IDEMPOTENCY_POLL_INTERVAL = 0.25
+IDEMPOTENCY_SWEEP_INTERVAL = 60
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+
+def request_fingerprint(*parts: Any) -> str:
+    """Stable hash of a request's parameters, to catch a key reused for a different request"""
+    payload = json.dumps(jsonable_encoder(parts), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """Replays the response of a request retried with the same Idempotency-Key.
+
+    The first request claims the key in the state backend and runs; its result
+    is kept for ``IDEMPOTENCY_TTL`` seconds. Retries arriving on any worker
+    meanwhile wait for the original rather than redoing its provider calls.
+    Failed requests release their claim so a retry can try again.
+    """
+
+    def __init__(
+        self,
+        backend: StateBackend,
+        ttl: int = IDEMPOTENCY_TTL,
+        lock_seconds: int = IDEMPOTENCY_LOCK_SECONDS,
+        max_keys: int = IDEMPOTENCY_MAX_KEYS
+    ):
+        self.keys_db = backend.collection(IDEMPOTENCY_NAMESPACE)
+        self.ttl = ttl
+        self.lock_seconds = lock_seconds
+        self.max_keys = max_keys
+        self._last_sweep = float("-inf")
+
+    async def run(
+        self,
+        scope: str,
+        key: Optional[str],
+        fingerprint: str,
+        call: Callable[[], Awaitable[Any]],
+        wait: float = IDEMPOTENCY_LOCK_SECONDS
+    ):
+        """Run ``call`` once per ``scope`` and key, replaying its response to retries"""
+        if not key:
+            return await call()
+        if len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+
+        record_key = f"{scope}:{hashlib.sha256(key.encode('utf-8')).hexdigest()}"
+        self._sweep()
+        waited_until = time.monotonic() + wait
+        while True:
+            now = time.time()
+            claim = {
+                "key": record_key,
+                "status": IN_PROGRESS,
+                "fingerprint": fingerprint,
+                "created_at": now,
+                "expires_at": now + self.lock_seconds
+            }
+            if self.keys_db.add(record_key, claim):
+                break
+
+            record = self.keys_db.get(record_key)
+            if record is None:
+                continue
+            if record["expires_at"] <= now:
+                # Expired result or abandoned claim; clear exactly that record, never a
+                # fresh claim another worker made meanwhile, and compete for the key again
+                self.keys_db.delete_if(record_key, record)
+                continue
+            if record["fingerprint"] != fingerprint:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Idempotency-Key was already used for a different request"
+                )
+            if record["status"] == COMPLETED:
+                return json_response(record["response"], headers={"Idempotent-Replayed": "true"})
+            if time.monotonic() >= waited_until:
+                raise HTTPException(
+                    status_code=409,
+                    detail="A request with this Idempotency-Key is still in progress",
+                    headers={"Retry-After": str(max(1, int(record["expires_at"] - now)))}
+                )
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+        try:
+            result = await call()
+        except BaseException:
+            # Our claim may have expired and been taken over; release only our own
+            self.keys_db.delete_if(record_key, claim)
+            raise
+
+        now = time.time()
+        self.keys_db[record_key] = {
+            "key": record_key,
+            "status": COMPLETED,
+            "fingerprint": fingerprint,
+            "created_at": now,
+            "expires_at": now + self.ttl,
+            "response": jsonable_encoder(result)
+        }
+        return result
+
+    def _sweep(self) -> None:
+        """Drop expired keys and, past ``max_keys``, the oldest ones"""
+        if time.monotonic() - self._last_sweep < IDEMPOTENCY_SWEEP_INTERVAL:
+            return
+        self._last_sweep = time.monotonic()
+        now = time.time()
+        live = []
+        for record in self.keys_db.values():
+            if record["expires_at"] <= now:
+                self.keys_db.delete_if(record["key"], record)
+            elif record["status"] == COMPLETED:
+                live.append((record["created_at"], record["key"]))
+        live.sort()
+        for _, record_key in live[:max(0, len(live) - self.max_keys)]:
+            self._discard(record_key)
+
+    def _discard(self, record_key: str) -> None:
+        try:
+            del self.keys_db[record_key]
+        except KeyError:
+            pass
+
+
+idempotency_store = IdempotencyStore(state_backend)
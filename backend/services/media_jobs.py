@@ -0,0 +1,103 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Optional
+from decouple import config
+from services.state_backend import StateBackend, state_backend
+
+MEDIA_JOBS_NAMESPACE = "media_jobs"
+# A processing job older than this is assumed abandoned by a crashed worker and may be claimed again
+MEDIA_JOB_LOCK_SECONDS = config('MEDIA_JOB_LOCK_SECONDS', default=300, cast=int)
+MEDIA_JOB_POLL_INTERVAL = 1.0
+
+PROCESSING = "processing"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class MediaJobs:
+    """Generation status per media id, shared by every worker and code path.
+
+    Media files are content addressed, so the same file can be asked for by
+    several routes at once. Whoever claims a media id generates it and reports
+    the outcome with ``finish``; everyone else waits for that outcome instead
+    of paying the provider for the same file again.
+    """
+
+    def __init__(self, backend: StateBackend, namespace: str = MEDIA_JOBS_NAMESPACE):
+        self.jobs_db = backend.collection(namespace)
+
+    def get(self, media_id: str) -> Optional[dict]:
+        return self.jobs_db.get(media_id)
+
+    @staticmethod
+    def _processing_job(media_id: str, media_type: str, file_path: Optional[str]) -> dict:
+        return {
+            "media_id": media_id,
+            "media_type": media_type,
+            "file_path": file_path,
+            "status": PROCESSING,
+            "started_at": time.time()
+        }
+
+    @staticmethod
+    def generating(job: Optional[dict]) -> bool:
+        """Whether a job is still being generated by a live worker"""
+        return bool(job) and job["status"] == PROCESSING and time.time() - job.get("started_at", 0) <= MEDIA_JOB_LOCK_SECONDS
+
+    def start(self, media_id: str, media_type: str, file_path: Optional[str]) -> None:
+        """Record a job for a media id no one else can be generating, such as a fresh uuid"""
+        self.jobs_db[media_id] = self._processing_job(media_id, media_type, file_path)
+
+    def claim(self, media_id: str, media_type: str, file_path: Optional[str]) -> bool:
+        """Take the right to generate a media id, so concurrent requests on any worker generate it once"""
+        claim = self._processing_job(media_id, media_type, file_path)
+        if self.jobs_db.add(media_id, claim):
+            return True
+        job = self.jobs_db.get(media_id)
+        if self.generating(job):
+            return False
+        # Only replace the finished or abandoned job we saw, never another worker's fresh claim
+        if job is not None and not self.jobs_db.delete_if(media_id, job):
+            return False
+        return self.jobs_db.add(media_id, claim)
+
+    def finish(self, media_id: str, succeeded: bool) -> None:
+        self.jobs_db.update_fields(media_id, status=COMPLETED if succeeded else FAILED)
+
+    async def wait(self, media_id: str) -> Optional[dict]:
+        """Wait until no live worker is generating a media id, returning its last job"""
+        job = self.jobs_db.get(media_id)
+        while self.generating(job):
+            await asyncio.sleep(MEDIA_JOB_POLL_INTERVAL)
+            job = self.jobs_db.get(media_id)
+        return job
+
+    async def generate_once(
+        self,
+        media_id: str,
+        media_type: str,
+        file_path: str,
+        generate: Callable[[], Awaitable[bool]]
+    ) -> bool:
+        """Make sure a file exists, generating it here only if no one else already is.
+
+        Generators write their file under a temporary name and rename it into
+        place, so an existing file is always a complete one.
+        """
+        while not os.path.exists(file_path):
+            if not self.claim(media_id, media_type, file_path):
+                job = await self.wait(media_id)
+                if job is not None and job["status"] == FAILED:
+                    return False
+                continue
+            succeeded = False
+            try:
+                succeeded = await generate()
+            finally:
+                self.finish(media_id, succeeded)
+            return succeeded
+        return True
+
+
+media_jobs = MediaJobs(state_backend)
@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+from services.admission import Ticket
+from services.audio_service import AudioService, narration_key
+from services.deadline import Deadline
+from services.gemini_service import GeminiService
+from services.media_jobs import MediaJobs
+from services.state_backend import StateBackend
+from services.visual_service import VisualService
+
+PIPELINE_NAMESPACE = "media_pipelines"
+STAGE_CACHE_NAMESPACE = "media_stage_cache"
+STAGE_CLAIMS_NAMESPACE = "media_stage_claims"
+
+# Stages in dependency order: description -> image -> thumbnail, alongside audio
+STAGES = ("description", "image", "thumbnail", "audio")
+
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+# Part of every stage key; bump it to stop reusing results cached by older code
+STAGE_CACHE_VERSION = "2"
+
+
+def _stage_key(stage: str, *parts: str) -> str:
+    payload = "\x1f".join((STAGE_CACHE_VERSION, stage) + parts)
+    return f"{stage}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]}"
+
+
+class MediaPipeline:
+    """Builds a story's media as two independent branches of dependent stages.
+
+    The visual branch turns the story into a description, the description into
+    an image and the image into a thumbnail; the audio branch narrates the text.
+    Both branches run concurrently, so full media is ready after the slower one.
+    Stage results are cached by their inputs, and each finished stage publishes
+    its URL to the story with a single field update. Stages call providers
+    strictly, so fallback descriptions and placeholder images fail the stage
+    instead of entering the cache. A stage already being computed by another
+    pipeline is waited for rather than computed twice, and narration shares
+    its single-flight claim with the audio routes.
+    """
+
+    def __init__(
+        self,
+        gemini_service: GeminiService,
+        visual_service: VisualService,
+        audio_service: AudioService,
+        backend: StateBackend
+    ):
+        self.gemini_service = gemini_service
+        self.visual_service = visual_service
+        self.audio_service = audio_service
+        self.pipelines_db = backend.collection(PIPELINE_NAMESPACE)
+        self.stage_cache = backend.collection(STAGE_CACHE_NAMESPACE)
+        self.stage_claims = MediaJobs(backend, STAGE_CLAIMS_NAMESPACE)
+        self.media_jobs = MediaJobs(backend)
+        self.stories_db = backend.collection("stories", versioned=True)
+
+    def create(self, story: dict, quality: str) -> dict:
+        """Record a new pipeline for a story with every stage pending"""
+        pipeline = {
+            "pipeline_id": str(uuid.uuid4()),
+            "story_id": story["story_id"],
+            "quality": quality,
+            "status": PENDING,
+            "created_at": time.time(),
+            **{stage: {"status": PENDING} for stage in STAGES}
+        }
+        self.pipelines_db[pipeline["pipeline_id"]] = pipeline
+        return pipeline
+
+    def get(self, pipeline_id: str) -> Optional[dict]:
+        return self.pipelines_db.get(pipeline_id)
+
+    async def run(self, pipeline_id: str, story: dict, quality: str, visual_ticket: Ticket, audio_ticket: Ticket):
+        """Run both branches, releasing each admission ticket as its branch finishes"""
+        self.pipelines_db.update_fields(pipeline_id, status=RUNNING)
+        await asyncio.gather(
+            self._visual_branch(pipeline_id, story, visual_ticket),
+            self._audio_branch(pipeline_id, story, quality, audio_ticket)
+        )
+        pipeline = self.pipelines_db.get(pipeline_id) or {}
+        succeeded = all(pipeline.get(stage, {}).get("status") == COMPLETED for stage in STAGES)
+        self.pipelines_db.update_fields(pipeline_id, status=COMPLETED if succeeded else FAILED, finished_at=time.time())
+
+    async def _visual_branch(self, pipeline_id: str, story: dict, ticket: Ticket):
+        with ticket:
+            description_input = story["enhanced_content"][:200]
+            context = f"{story['culture']} {story['story_type']}"
+            description = await self._stage(
+                pipeline_id,
+                "description",
+                _stage_key("description", description_input, context),
+                lambda: self._describe(description_input, context)
+            )
+            if description is None:
+                self._skip(pipeline_id, "image", "thumbnail")
+                return
+
+            image_key = _stage_key("image", description["description"], "illustration")
+            image = await self._stage(
+                pipeline_id,
+                "image",
+                image_key,
+                lambda: self._render(image_key, description["description"])
+            )
+            if image is None:
+                self._skip(pipeline_id, "thumbnail")
+                return
+            self.stories_db.update_fields(story["story_id"], image_url=image["url"])
+
+        thumbnail_key = _stage_key("thumbnail", image["path"])
+        thumbnail = await self._stage(
+            pipeline_id,
+            "thumbnail",
+            thumbnail_key,
+            lambda: self._thumbnail(thumbnail_key, image["path"])
+        )
+        if thumbnail is not None:
+            self.stories_db.update_fields(story["story_id"], image_thumbnail_url=thumbnail["url"])
+
+    async def _audio_branch(self, pipeline_id: str, story: dict, quality: str, ticket: Ticket):
+        with ticket:
+            audio_id = f"{narration_key(story['enhanced_content'], story['language'], 'narrative', None)}_{quality}"
+            audio = await self._stage(
+                pipeline_id,
+                "audio",
+                _stage_key("audio", audio_id),
+                lambda: self._narrate(audio_id, story, quality)
+            )
+        if audio is not None:
+            self.stories_db.merge_fields(
+                story["story_id"],
+                {"audio_variants": {quality: audio["url"]}},
+                audio_url=audio["url"]
+            )
+
+    async def _stage(self, pipeline_id: str, stage: str, cache_key: str, compute: Callable[[], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        """Serve a stage from the cache or compute it, recording its progress on the pipeline.
+
+        Only the pipeline holding the stage's claim computes it; any other
+        waits for that result to reach the cache.
+        """
+        started_at = time.time()
+        while True:
+            cached = self.stage_cache.get(cache_key)
+            if cached and self._still_valid(cached["result"]):
+                self.pipelines_db.update_fields(pipeline_id, **{stage: {"status": COMPLETED, "cached": True, **cached["result"]}})
+                return cached["result"]
+            if self.stage_claims.claim(cache_key, stage, None):
+                break
+            self.pipelines_db.update_fields(pipeline_id, **{stage: {"status": RUNNING, "started_at": started_at}})
+            job = await self.stage_claims.wait(cache_key)
+            if job is not None and job["status"] == FAILED:
+                self.pipelines_db.update_fields(pipeline_id, **{stage: {"status": FAILED, "started_at": started_at, "finished_at": time.time()}})
+                return None
+
+        self.pipelines_db.update_fields(pipeline_id, **{stage: {"status": RUNNING, "started_at": started_at}})
+        result = None
+        try:
+            result = await compute()
+        except Exception as e:
+            print(f"Error in media pipeline {pipeline_id} stage {stage}: {str(e)}")
+        finally:
+            # Cached before the claim is released, so waiting pipelines find the result
+            if result is not None:
+                self.stage_cache[cache_key] = {"stage": stage, "result": result, "created_at": time.time()}
+            self.stage_claims.finish(cache_key, result is not None)
+
+        timing = {"started_at": started_at, "finished_at": time.time()}
+        if result is None:
+            self.pipelines_db.update_fields(pipeline_id, **{stage: {"status": FAILED, **timing}})
+            return None
+        self.pipelines_db.update_fields(pipeline_id, **{stage: {"status": COMPLETED, "cached": False, **timing, **result}})
+        return result
+
+    def _skip(self, pipeline_id: str, *stages: str) -> None:
+        self.pipelines_db.update_fields(pipeline_id, **{stage: {"status": SKIPPED} for stage in stages})
+
+    @staticmethod
+    def _still_valid(result: Dict) -> bool:
+        # File-producing stages only count as cached while their file is still on disk
+        return "path" not in result or os.path.exists(result["path"])
+
+    async def _describe(self, description: str, context: str) -> dict:
+        text = await self.gemini_service.generate_visual_description(
+            description, context, Deadline.for_endpoint("visual"), strict=True
+        )
+        return {"description": text}
+
+    async def _render(self, cache_key: str, description: str) -> Optional[dict]:
+        filename = f"story_image_{cache_key.split(':')[1]}.png"
+        path = f"static/images/{filename}"
+        if not await self.visual_service.generate_image(description, path, "illustration", strict=True):
+            return None
+        return {"path": path, "url": f"/static/images/{filename}"}
+
+    async def _thumbnail(self, cache_key: str, image_path: str) -> Optional[dict]:
+        filename = f"thumb_{cache_key.split(':')[1]}.jpg"
+        path = f"static/images/{filename}"
+        if not await self.visual_service.create_thumbnail(image_path, path):
+            return None
+        return {"path": path, "url": f"/static/images/{filename}"}
+
+    async def _narrate(self, audio_id: str, story: dict, quality: str) -> Optional[dict]:
+        filename = f"audio_{audio_id}.mp3"
+        path = f"static/audio/{filename}"
+        # The same file may be generating for /generate-audio or a scene narration
+        succeeded = await self.media_jobs.generate_once(
+            audio_id,
+            "audio",
+            path,
+            lambda: self.audio_service.generate_audio(
+                story["enhanced_content"], path, story["language"], "narrative", None, quality=quality
+            )
+        )
+        if not succeeded:
+            return None
+        return {"path": path, "url": f"/static/audio/{filename}", "quality": quality}
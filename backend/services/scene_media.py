@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+from decouple import config
+from fastapi import HTTPException
+from services.admission import Ticket, admission_controller
+from services.audio_service import AudioService, narration_key
+from services.deadline import Deadline
+from services.gemini_service import GeminiService
+from services.media_jobs import MediaJobs
+from services.state_backend import StateBackend
+from services.visual_service import VisualService
+
+SCENE_MEDIA_NAMESPACE = "scene_media"
+SCENE_CHOICES_NAMESPACE = "scene_choices"
+SCENE_MEDIA_KINDS = ("image", "audio")
+# A generating record older than this is assumed abandoned and may be claimed again
+SCENE_MEDIA_LOCK_SECONDS = config('SCENE_MEDIA_LOCK_SECONDS', default=300, cast=int)
+# Failed media is only retried after this long, so polling clients do not re-trigger paid calls
+SCENE_MEDIA_RETRY_SECONDS = config('SCENE_MEDIA_RETRY_SECONDS', default=60, cast=int)
+
+GENERATING = "generating"
+COMPLETED = "completed"
+FAILED = "failed"
+MISSING = "missing"
+
+# Providers each kind of scene media is generated with
+KIND_PROVIDERS = {
+    "image": ("gemini", "stability"),
+    "audio": ("elevenlabs",),
+}
+
+
+def scene_key(scene: str, language: str) -> str:
+    """Stable id for a scene, shared by every session that reaches the same text"""
+    payload = json.dumps([scene, language], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class SceneMediaService:
+    """Generates narration and illustrations for individual interactive scenes.
+
+    Nothing is generated until a client asks for a scene's media. Results are
+    keyed by scene text, so sessions reaching the same scene share them, and a
+    request can prefetch the scene its players most often choose next.
+    """
+
+    def __init__(
+        self,
+        gemini_service: GeminiService,
+        visual_service: VisualService,
+        audio_service: AudioService,
+        backend: StateBackend
+    ):
+        self.gemini_service = gemini_service
+        self.visual_service = visual_service
+        self.audio_service = audio_service
+        self.media_db = backend.collection(SCENE_MEDIA_NAMESPACE)
+        self.choices_db = backend.collection(SCENE_CHOICES_NAMESPACE)
+        self.media_jobs = MediaJobs(backend)
+        self._tasks = set()
+
+    def _asset(self, scene: str, language: str, kind: str, quality: str, style: str) -> dict:
+        """Record key, file path and URL of one kind of media for a scene"""
+        key = scene_key(scene, language)
+        if kind == "image":
+            filename = f"scene_{key}_{style}.png"
+            return {"record": f"{key}:image_{style}", "path": f"static/images/{filename}", "url": f"/static/images/{filename}"}
+        # Narration files are shared with story audio variants of the same text
+        audio_id = f"{narration_key(scene, language, 'narrative', None)}_{quality}"
+        filename = f"audio_{audio_id}.mp3"
+        return {
+            "record": f"{key}:audio_{quality}",
+            "media_id": audio_id,
+            "path": f"static/audio/{filename}",
+            "url": f"/static/audio/{filename}"
+        }
+
+    def status(
+        self,
+        scene: str,
+        language: str,
+        kinds: Iterable[str],
+        quality: str = "standard",
+        style: str = "illustration"
+    ) -> Dict[str, dict]:
+        statuses = {}
+        for kind in kinds:
+            asset = self._asset(scene, language, kind, quality, style)
+            record = self.media_db.get(asset["record"])
+            if record and record["status"] != COMPLETED:
+                status = record["status"]
+            else:
+                status = COMPLETED if os.path.exists(asset["path"]) else MISSING
+            statuses[kind] = {"status": status, "url": asset["url"] if status == COMPLETED else None}
+        return statuses
+
+    def ensure(
+        self,
+        scene: str,
+        language: str,
+        context: str,
+        kinds: Iterable[str],
+        quality: str = "standard",
+        style: str = "illustration",
+        prefetch: bool = False
+    ) -> Dict[str, dict]:
+        """Start generating whichever requested media the scene lacks, returning its status.
+
+        Requests over provider capacity are rejected with 503, except for
+        prefetches, which are simply dropped. ``quality`` applies to narration
+        and ``style`` to illustrations, each variant being generated separately.
+        """
+        for kind, current in self.status(scene, language, kinds, quality, style).items():
+            asset = self._asset(scene, language, kind, quality, style)
+            if current["status"] != MISSING and not self._stale(self.media_db.get(asset["record"])):
+                continue
+            try:
+                ticket = admission_controller.admit(*KIND_PROVIDERS[kind])
+            except HTTPException:
+                if prefetch:
+                    continue
+                raise
+            if not self._claim(asset["record"]):
+                ticket.release()
+                continue
+            self._spawn(self._generate(asset, kind, scene, language, context, quality, style, ticket))
+        return self.status(scene, language, kinds, quality, style)
+
+    def record_choice(self, scene: str, language: str, choice_id: str) -> None:
+        """Count a choice taken from a scene, to rank look-ahead candidates"""
+        key = scene_key(scene, language)
+        self.choices_db.add(key, {})
+        self.choices_db.increment_fields(key, **{choice_id: 1})
+
+    def likely_choice(self, scene: str, language: str, choice_ids: List[str]) -> Optional[str]:
+        """Choice players most often take from a scene, defaulting to the first one"""
+        if not choice_ids:
+            return None
+        counts = self.choices_db.get(scene_key(scene, language)) or {}
+        return max(choice_ids, key=lambda choice_id: counts.get(choice_id, 0))
+
+    @staticmethod
+    def _stale(record: Optional[dict]) -> bool:
+        """Whether a generating or failed record may be replaced by a new attempt"""
+        if not record:
+            return False
+        if record["status"] == GENERATING:
+            return time.time() - record["started_at"] > SCENE_MEDIA_LOCK_SECONDS
+        if record["status"] == FAILED:
+            return time.time() - record["finished_at"] > SCENE_MEDIA_RETRY_SECONDS
+        return False
+
+    def _claim(self, record_key: str) -> bool:
+        """Take the right to generate an asset, so concurrent sessions generate it once"""
+        claim = {"status": GENERATING, "started_at": time.time()}
+        if self.media_db.add(record_key, claim):
+            return True
+        record = self.media_db.get(record_key)
+        if record and record["status"] != COMPLETED and not self._stale(record):
+            return False
+        # Only replace the record we saw, never another session's fresh claim
+        if record is not None and not self.media_db.delete_if(record_key, record):
+            return False
+        return self.media_db.add(record_key, claim)
+
+    def _discard(self, record_key: str) -> None:
+        try:
+            del self.media_db[record_key]
+        except KeyError:
+            pass
+
+    def _spawn(self, coroutine) -> None:
+        # Generation outlives the request that started it; keep a reference until it finishes
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _generate(
+        self, asset: dict, kind: str, scene: str, language: str, context: str, quality: str, style: str, ticket: Ticket
+    ):
+        with ticket:
+            try:
+                if kind == "image":
+                    # The description prompt uses scene_context in place of the text, so it must carry the scene
+                    description = await self.gemini_service.generate_visual_description(
+                        scene[:300], f"{context}: {scene[:300]}", Deadline.for_endpoint("visual"), strict=True
+                    )
+                    succeeded = await self.visual_service.generate_image(description, asset["path"], style, strict=True)
+                else:
+                    succeeded = await self.media_jobs.generate_once(
+                        asset["media_id"],
+                        "audio",
+                        asset["path"],
+                        lambda: self.audio_service.generate_audio(
+                            scene, asset["path"], language, "narrative", None, quality=quality
+                        )
+                    )
+            except asyncio.CancelledError:
+                # Let the next request claim the asset instead of waiting out the lock
+                self._discard(asset["record"])
+                raise
+            except Exception as e:
+                print(f"Error generating scene {kind}: {str(e)}")
+                succeeded = False
+
+        self.media_db[asset["record"]] = {
+            "status": COMPLETED if succeeded else FAILED,
+            "finished_at": time.time()
+        }
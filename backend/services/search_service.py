@@ -0,0 +1,221 @@
+import heapq
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional, Set
+from models.schemas import Language
+from services.state_backend import LOG_RETAIN, StateCollection
+
+# Searchable story fields and how many times each token counts towards its story
+FIELD_WEIGHTS = {
+    "title": 3,
+    "culture": 2,
+    "tags": 2,
+    "enhanced_content": 1,
+}
+
+STOPWORDS = {
+    Language.ENGLISH: {
+        "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "from", "had", "has",
+        "he", "her", "his", "in", "into", "is", "it", "its", "of", "on", "or", "she", "that",
+        "the", "their", "they", "this", "to", "was", "were", "with",
+    },
+    Language.HINDI: {
+        "और", "का", "की", "के", "को", "में", "से", "है", "हैं", "था", "थी", "थे", "पर",
+        "एक", "यह", "वह", "ने", "भी", "तो", "ही",
+    },
+    Language.SPANISH: {
+        "el", "la", "los", "las", "un", "una", "unos", "unas", "y", "o", "de", "del", "en",
+        "con", "por", "para", "que", "se", "su", "sus", "al", "es", "era", "lo",
+    },
+    Language.FRENCH: {
+        "le", "la", "les", "un", "une", "des", "et", "ou", "de", "du", "en", "dans", "avec",
+        "pour", "par", "que", "qui", "se", "sa", "son", "ses", "au", "aux", "est", "etait",
+    },
+    Language.GERMAN: {
+        "der", "die", "das", "den", "dem", "des", "ein", "eine", "einen", "einem", "und",
+        "oder", "in", "im", "mit", "von", "zu", "zum", "zur", "auf", "fur", "ist", "war",
+        "sich", "sie", "er", "es",
+    },
+}
+
+# Devanagari vowel signs are combining marks, which \w alone would split on
+TOKEN_PATTERN = re.compile(r"[\w\u0900-\u097F]+")
+
+
+def _fold_accents(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def _stem(token: str, language: Language) -> str:
+    """Light plural stripping so 'tales' matches 'tale'"""
+    if language in (Language.ENGLISH, Language.FRENCH, Language.SPANISH):
+        if language == Language.SPANISH and len(token) > 4 and token.endswith("es"):
+            return token[:-2]
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            return token[:-1]
+    if language == Language.GERMAN and len(token) > 4 and token.endswith(("en", "er")):
+        return token[:-2]
+    return token
+
+
+def tokenize(text: str, language: Language = Language.ENGLISH) -> List[str]:
+    """Split text into normalized search terms for the given language"""
+    text = text.lower()
+    if language != Language.HINDI:
+        # Accents are folded for Latin scripts; Hindi keeps its combining marks
+        text = _fold_accents(text)
+    stopwords = STOPWORDS.get(language, set())
+    return [
+        _stem(token, language)
+        for token in TOKEN_PATTERN.findall(text)
+        if token not in stopwords
+    ]
+
+
+class SearchService:
+    """BM25 full-text index over stories, kept in sync through the state backend's change log.
+
+    Writers call ``notify`` after changing a story; every worker replays new log
+    entries before answering a query, so indexes stay consistent across workers.
+    Building the index scans every story, so it is done once off the event loop
+    by ``warm`` and again only by workers that fall too far behind the log.
+    """
+
+    LOG_NAMESPACE = "story_changes"
+
+    def __init__(self, stories_db: StateCollection, k1: float = 1.2, b: float = 0.75):
+        self.stories_db = stories_db
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._doc_terms: Dict[str, Counter] = {}
+        self._doc_lengths: Dict[str, int] = {}
+        self._doc_meta: Dict[str, dict] = {}
+        self._total_length = 0
+        self._log_position = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def notify(self, story_id: str) -> None:
+        """Record that a story was created, updated or deleted"""
+        self.stories_db.backend.append_log(self.LOG_NAMESPACE, {"story_id": story_id})
+
+    def _analyze(self, story: dict) -> Counter:
+        try:
+            language = Language(story.get("language", Language.ENGLISH))
+        except ValueError:
+            language = Language.ENGLISH
+        terms = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            value = story.get(field) or ""
+            if isinstance(value, list):
+                value = " ".join(value)
+            for token in tokenize(value, language):
+                terms[token] += weight
+        return terms
+
+    def _remove(self, story_id: str) -> None:
+        terms = self._doc_terms.pop(story_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self._postings[term]
+            del postings[story_id]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._doc_lengths.pop(story_id)
+        del self._doc_meta[story_id]
+
+    def _add(self, story: dict) -> None:
+        story_id = story["story_id"]
+        self._remove(story_id)
+        terms = self._analyze(story)
+        self._doc_terms[story_id] = terms
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[story_id] = frequency
+        length = sum(terms.values())
+        self._doc_lengths[story_id] = length
+        self._total_length += length
+        self._doc_meta[story_id] = {
+            "language": story.get("language"),
+            "story_type": story.get("story_type"),
+            "culture": (story.get("culture") or "").lower(),
+        }
+
+    def warm(self) -> None:
+        """Build the index ahead of the first query"""
+        with self._lock:
+            self._sync()
+
+    def _reload(self, log_tail: int) -> None:
+        self._postings, self._doc_terms, self._doc_lengths, self._doc_meta = {}, {}, {}, {}
+        self._total_length = 0
+        # The log position is taken before the full scan so writes racing it are replayed
+        self._log_position = log_tail
+        for story in self.stories_db.values():
+            self._add(story)
+        self._loaded = True
+
+    def _sync(self) -> None:
+        """Load the index on first use, then apply changes logged since the last sync"""
+        backend = self.stories_db.backend
+        log_tail = backend.log_tail(self.LOG_NAMESPACE)
+        if not self._loaded or log_tail - self._log_position > LOG_RETAIN // 2:
+            self._reload(log_tail)
+
+        changed = backend.read_log(self.LOG_NAMESPACE, self._log_position)
+        for seq, entry in changed:
+            story = self.stories_db.get(entry["story_id"])
+            if story is None:
+                self._remove(entry["story_id"])
+            else:
+                self._add(story)
+            self._log_position = seq
+
+    def search(
+        self,
+        query: str,
+        language: Optional[Language] = None,
+        story_type: Optional[str] = None,
+        culture: Optional[str] = None,
+        limit: int = 20
+    ) -> List[dict]:
+        """Return ``[{"story_id", "score"}]`` ranked by BM25, best match first"""
+        with self._lock:
+            self._sync()
+
+            # Without a language filter, match the query as any supported language would analyze it
+            languages = [language] if language else list(Language)
+            terms: Set[str] = set()
+            for lang in languages:
+                terms.update(tokenize(query, lang))
+
+            doc_count = len(self._doc_lengths)
+            if not terms or not doc_count:
+                return []
+            average_length = self._total_length / doc_count
+            culture = culture.lower() if culture else None
+
+            scores: Dict[str, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for story_id, frequency in postings.items():
+                    meta = self._doc_meta[story_id]
+                    if language and meta["language"] != language:
+                        continue
+                    if story_type and meta["story_type"] != story_type:
+                        continue
+                    if culture and culture not in meta["culture"]:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[story_id] / average_length)
+                    scores[story_id] = scores.get(story_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+            top = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [{"story_id": story_id, "score": round(score, 4)} for story_id, score in top]
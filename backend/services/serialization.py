@@ -0,0 +1,46 @@
+import hashlib
+from typing import Dict, Optional
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:
+    # orjson is optional; fall back to the standard encoder when it is missing
+    FastJSONResponse = JSONResponse
+
+
+def json_response(content, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+    """Serialize a large, already JSON-friendly payload with the fastest available encoder"""
+    return FastJSONResponse(content=content, status_code=status_code, headers=headers)
+
+
+def make_etag(*parts) -> str:
+    """Weak ETag derived from a resource's identity and version.
+
+    Weak, because the compression middleware may encode the same representation
+    differently per client.
+    """
+    digest = hashlib.sha1(":".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    # no-cache: clients may keep the body but must revalidate it with If-None-Match
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match already names ``etag``"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == bare for tag in header.split(","))
+
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag))
@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import itertools
+import random
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+from decouple import config
+from models.schemas import StoryInput
+from services.search_service import TOKEN_PATTERN
+from services.state_backend import LOG_RETAIN, StateBackend
+
+# 2^61 - 1, a Mersenne prime large enough for 64-bit shingle hashes
+MERSENNE_PRIME = (1 << 61) - 1
+# Only the leading words are shingled, bounding signature cost for very long stories
+DEDUP_MAX_WORDS = config('DEDUP_MAX_WORDS', default=2000, cast=int)
+
+
+class SimilarityService:
+    """MinHash/LSH index over submitted story text for near-duplicate detection.
+
+    Signatures live in the state backend so every worker sees them; each worker
+    keeps its own LSH buckets and replays a change log to stay in sync.
+    """
+
+    SIGNATURE_NAMESPACE = "story_signatures"
+    LOG_NAMESPACE = "signature_changes"
+
+    def __init__(
+        self,
+        backend: StateBackend,
+        num_perm: int = 128,
+        bands: int = 32,
+        shingle_size: int = 3,
+        threshold: float = None
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.backend = backend
+        self.signatures_db = backend.collection(self.SIGNATURE_NAMESPACE)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.threshold = threshold if threshold is not None else config(
+            'DEDUP_SIMILARITY_THRESHOLD', default=0.85, cast=float
+        )
+        # Fixed seed so every worker computes identical signatures
+        rng = random.Random(1)
+        self._permutations = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        self._buckets: Dict[Tuple[int, int], Set[str]] = {}
+        self._records: Dict[str, dict] = {}
+        self._log_position = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _shingles(self, text: str) -> Set[int]:
+        words = [match.group() for match in itertools.islice(TOKEN_PATTERN.finditer(text.lower()), DEDUP_MAX_WORDS)]
+        if len(words) < self.shingle_size:
+            words = words + [""] * (self.shingle_size - len(words))
+        shingles = set()
+        for i in range(len(words) - self.shingle_size + 1):
+            shingle = " ".join(words[i:i + self.shingle_size]).encode("utf-8")
+            shingles.add(int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), "big"))
+        return shingles
+
+    def signature(self, text: str) -> List[int]:
+        """MinHash signature of the text's word shingles"""
+        shingles = self._shingles(text)
+        return [
+            min((a * shingle + b) % MERSENNE_PRIME for shingle in shingles)
+            for a, b in self._permutations
+        ]
+
+    async def signature_async(self, text: str) -> List[int]:
+        """``signature`` computed in a worker thread, keeping the event loop free"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.signature, text)
+
+    @staticmethod
+    def estimate_similarity(left: List[int], right: List[int]) -> float:
+        """Estimated Jaccard similarity of two signatures"""
+        return sum(1 for x, y in zip(left, right) if x == y) / len(left)
+
+    def _band_keys(self, signature: List[int]) -> List[Tuple[int, int]]:
+        return [
+            (band, hash(tuple(signature[band * self.rows:(band + 1) * self.rows])))
+            for band in range(self.bands)
+        ]
+
+    def _index(self, story_id: str, record: dict) -> None:
+        self._unindex(story_id)
+        self._records[story_id] = record
+        for key in self._band_keys(record["signature"]):
+            self._buckets.setdefault(key, set()).add(story_id)
+
+    def _unindex(self, story_id: str) -> None:
+        record = self._records.pop(story_id, None)
+        if record is None:
+            return
+        for key in self._band_keys(record["signature"]):
+            bucket = self._buckets.get(key)
+            if bucket:
+                bucket.discard(story_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def warm(self) -> None:
+        """Build the LSH buckets ahead of the first lookup"""
+        with self._lock:
+            self._sync()
+
+    def _sync(self) -> None:
+        log_tail = self.backend.log_tail(self.LOG_NAMESPACE)
+        if not self._loaded or log_tail - self._log_position > LOG_RETAIN // 2:
+            self._buckets, self._records = {}, {}
+            self._log_position = log_tail
+            for record in self.signatures_db.values():
+                self._index(record["story_id"], record)
+            self._loaded = True
+
+        for seq, entry in self.backend.read_log(self.LOG_NAMESPACE, self._log_position):
+            record = self.signatures_db.get(entry["story_id"])
+            if record is None:
+                self._unindex(entry["story_id"])
+            else:
+                self._index(entry["story_id"], record)
+            self._log_position = seq
+
+    def register(self, story_id: str, story_input: StoryInput, signature: List[int] = None) -> None:
+        """Store the signature of a story's submitted content"""
+        self.signatures_db[story_id] = {
+            "story_id": story_id,
+            "signature": signature or self.signature(story_input.content),
+            "language": story_input.language,
+            "story_type": story_input.story_type,
+            "target_age_group": story_input.target_age_group
+        }
+        self.backend.append_log(self.LOG_NAMESPACE, {"story_id": story_id})
+
+    def remove(self, story_id: str) -> None:
+        if story_id in self.signatures_db:
+            del self.signatures_db[story_id]
+            self.backend.append_log(self.LOG_NAMESPACE, {"story_id": story_id})
+
+    def find_duplicate(self, story_input: StoryInput, signature: List[int] = None) -> Optional[dict]:
+        """Return ``{"story_id", "similarity"}`` of the closest compatible story above the threshold"""
+        signature = signature or self.signature(story_input.content)
+        with self._lock:
+            self._sync()
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates.update(self._buckets.get(key, ()))
+
+            best = None
+            for story_id in candidates:
+                record = self._records[story_id]
+                if (
+                    record["language"] != story_input.language
+                    or record["story_type"] != story_input.story_type
+                    or record["target_age_group"] != story_input.target_age_group
+                ):
+                    continue
+                similarity = self.estimate_similarity(signature, record["signature"])
+                if similarity >= self.threshold and (best is None or similarity > best["similarity"]):
+                    best = {"story_id": story_id, "similarity": similarity}
+            return best
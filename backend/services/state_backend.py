@@ -0,0 +1,574 @@
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+import threading
+import time
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from decouple import config
+
+# Change log entries kept per namespace; readers further behind than this reload from scratch
+LOG_RETAIN = config('STATE_LOG_RETAIN', default=10000, cast=int)
+LOG_TRIM_INTERVAL = 500
+
+
+class StateBackend(ABC):
+    """Namespaced key/value store for stories, sessions and media jobs.
+
+    Values are JSON documents, so every backend hands out copies: mutate the
+    returned dict and write it back (or use ``update``) to persist a change.
+
+    Calls are synchronous and routes make them on the event loop. They are
+    meant to be single-key lookups of a few milliseconds; a backend stalled on
+    write contention stalls its whole worker for up to its lock timeout, so
+    deployments past one host should use Redis rather than a shared SQLite file.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add(self, namespace: str, key: str, value: Dict[str, Any]) -> bool:
+        """Store ``value`` only if ``key`` is absent, returning whether it was stored"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_if(self, namespace: str, key: str, expected: Dict[str, Any]) -> bool:
+        """Delete ``key`` only while it still holds ``expected``, returning whether it was deleted"""
+        raise NotImplementedError
+
+    def exists(self, namespace: str, key: str) -> bool:
+        return self.get(namespace, key) is not None
+
+    @abstractmethod
+    def keys(self, namespace: str) -> List[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def values(self, namespace: str) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def update(
+        self,
+        namespace: str,
+        key: str,
+        fields: Dict[str, Any],
+        nested: Optional[Dict[str, Dict[str, Any]]] = None,
+        increments: Optional[Dict[str, int]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Atomically merge ``fields`` into an existing value, returning the result.
+
+        Each entry of ``nested`` is merged into the dict field of the same name
+        rather than replacing it, and each of ``increments`` is added to its
+        numeric field, counting a missing field as zero.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _merge(
+        value: Dict[str, Any],
+        fields: Dict[str, Any],
+        nested: Optional[Dict[str, Dict[str, Any]]],
+        increments: Optional[Dict[str, int]]
+    ) -> None:
+        value.update(fields)
+        for field, entries in (nested or {}).items():
+            value[field] = {**(value.get(field) or {}), **entries}
+        for field, amount in (increments or {}).items():
+            value[field] = value.get(field, 0) + amount
+
+    @abstractmethod
+    def append_log(self, namespace: str, entry: Dict[str, Any]) -> int:
+        """Append to an ordered change log, returning the entry's sequence number"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_log(self, namespace: str, after: int = 0) -> List[Tuple[int, Dict[str, Any]]]:
+        """Return retained log entries with a sequence number greater than ``after``"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def log_tail(self, namespace: str) -> int:
+        """Sequence number of the latest log entry, or 0 for an empty log"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def trim_log(self, namespace: str, upto: int) -> None:
+        """Drop log entries with a sequence number up to and including ``upto``"""
+        raise NotImplementedError
+
+    def _compact_log(self, namespace: str, seq: int) -> None:
+        # Every so often an append drops entries older than the retained window
+        if seq % LOG_TRIM_INTERVAL == 0 and seq > LOG_RETAIN:
+            self.trim_log(namespace, seq - LOG_RETAIN)
+
+    def collection(self, namespace: str, versioned: bool = False, collection_version: bool = True) -> "StateCollection":
+        return StateCollection(self, namespace, versioned, collection_version)
+
+    @staticmethod
+    def _dumps(value: Dict[str, Any]) -> str:
+        return json.dumps(value, ensure_ascii=False)
+
+    @staticmethod
+    def _loads(raw) -> Optional[Dict[str, Any]]:
+        return json.loads(raw) if raw is not None else None
+
+
+class MemoryStateBackend(StateBackend):
+    """Single-process backend, only suitable for development with one worker"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, str]] = {}
+        self._logs: Dict[str, List[Tuple[int, str]]] = {}
+        self._log_seqs: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        return self._loads(self._data.get(namespace, {}).get(key))
+
+    def set(self, namespace, key, value):
+        with self._lock:
+            self._data.setdefault(namespace, {})[key] = self._dumps(value)
+
+    def add(self, namespace, key, value):
+        with self._lock:
+            bucket = self._data.setdefault(namespace, {})
+            if key in bucket:
+                return False
+            bucket[key] = self._dumps(value)
+            return True
+
+    def delete(self, namespace, key):
+        with self._lock:
+            return self._data.get(namespace, {}).pop(key, None) is not None
+
+    def delete_if(self, namespace, key, expected):
+        with self._lock:
+            bucket = self._data.get(namespace, {})
+            if key not in bucket or self._loads(bucket[key]) != expected:
+                return False
+            del bucket[key]
+            return True
+
+    def exists(self, namespace, key):
+        return key in self._data.get(namespace, {})
+
+    def keys(self, namespace):
+        return list(self._data.get(namespace, {}).keys())
+
+    def values(self, namespace):
+        return [self._loads(raw) for raw in list(self._data.get(namespace, {}).values())]
+
+    def update(self, namespace, key, fields, nested=None, increments=None):
+        with self._lock:
+            bucket = self._data.get(namespace, {})
+            if key not in bucket:
+                return None
+            value = self._loads(bucket[key])
+            self._merge(value, fields, nested, increments)
+            bucket[key] = self._dumps(value)
+            return value
+
+    def append_log(self, namespace, entry):
+        with self._lock:
+            seq = self._log_seqs.get(namespace, 0) + 1
+            self._log_seqs[namespace] = seq
+            self._logs.setdefault(namespace, []).append((seq, self._dumps(entry)))
+        self._compact_log(namespace, seq)
+        return seq
+
+    def read_log(self, namespace, after=0):
+        log = list(self._logs.get(namespace, []))
+        return [(seq, self._loads(raw)) for seq, raw in log if seq > after]
+
+    def log_tail(self, namespace):
+        return self._log_seqs.get(namespace, 0)
+
+    def trim_log(self, namespace, upto):
+        with self._lock:
+            log = self._logs.get(namespace, [])
+            self._logs[namespace] = [(seq, raw) for seq, raw in log if seq > upto]
+
+
+class SQLiteStateBackend(StateBackend):
+    """Backend over a local SQLite file shared by every worker on the host"""
+
+    name = "sqlite"
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        # Longest a call waits for another worker's write lock, blocking its event loop meanwhile
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state_log ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, entry TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS state_log_namespace ON state_log (namespace, seq)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # WAL lets readers in other workers proceed while one worker writes
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace, key):
+        row = self._connection().execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return self._loads(row[0]) if row else None
+
+    def set(self, namespace, key, value):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)",
+            (namespace, key, self._dumps(value))
+        )
+
+    def add(self, namespace, key, value):
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO state (namespace, key, value) VALUES (?, ?, ?)",
+            (namespace, key, self._dumps(value))
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, namespace, key):
+        cursor = self._connection().execute(
+            "DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+        )
+        return cursor.rowcount > 0
+
+    def delete_if(self, namespace, key, expected):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row is None or self._loads(row[0]) != expected:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def exists(self, namespace, key):
+        row = self._connection().execute(
+            "SELECT 1 FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return row is not None
+
+    def keys(self, namespace):
+        rows = self._connection().execute(
+            "SELECT key FROM state WHERE namespace = ?", (namespace,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def values(self, namespace):
+        rows = self._connection().execute(
+            "SELECT value FROM state WHERE namespace = ?", (namespace,)
+        ).fetchall()
+        return [self._loads(row[0]) for row in rows]
+
+    def update(self, namespace, key, fields, nested=None, increments=None):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return None
+            value = self._loads(row[0])
+            self._merge(value, fields, nested, increments)
+            conn.execute(
+                "UPDATE state SET value = ? WHERE namespace = ? AND key = ?",
+                (self._dumps(value), namespace, key)
+            )
+            conn.execute("COMMIT")
+            return value
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def append_log(self, namespace, entry):
+        cursor = self._connection().execute(
+            "INSERT INTO state_log (namespace, entry) VALUES (?, ?)", (namespace, self._dumps(entry))
+        )
+        self._compact_log(namespace, cursor.lastrowid)
+        return cursor.lastrowid
+
+    def _compact_log(self, namespace, seq):
+        # Sequence numbers are shared by every namespace, so the window is trimmed across all of them
+        if seq % LOG_TRIM_INTERVAL == 0 and seq > LOG_RETAIN:
+            self._connection().execute("DELETE FROM state_log WHERE seq <= ?", (seq - LOG_RETAIN,))
+
+    def read_log(self, namespace, after=0):
+        rows = self._connection().execute(
+            "SELECT seq, entry FROM state_log WHERE namespace = ? AND seq > ? ORDER BY seq",
+            (namespace, after)
+        ).fetchall()
+        return [(row[0], self._loads(row[1])) for row in rows]
+
+    def log_tail(self, namespace):
+        row = self._connection().execute(
+            "SELECT MAX(seq) FROM state_log WHERE namespace = ?", (namespace,)
+        ).fetchone()
+        return row[0] or 0
+
+    def trim_log(self, namespace, upto):
+        self._connection().execute(
+            "DELETE FROM state_log WHERE namespace = ? AND seq <= ?", (namespace, upto)
+        )
+
+
+class RedisStateBackend(StateBackend):
+    """Backend over a Redis-compatible server, shared across workers and hosts"""
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "storyteller"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis requires the 'redis' package")
+        self._redis = redis
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self._append_script = self.client.register_script(
+            "local seq = redis.call('INCR', KEYS[1]) "
+            "redis.call('RPUSH', KEYS[2], '{\"seq\": ' .. seq .. ', \"entry\": ' .. ARGV[1] .. '}') "
+            "return seq"
+        )
+
+    def _hash(self, namespace: str) -> str:
+        return f"{self.prefix}:{namespace}"
+
+    def get(self, namespace, key):
+        return self._loads(self.client.hget(self._hash(namespace), key))
+
+    def set(self, namespace, key, value):
+        self.client.hset(self._hash(namespace), key, self._dumps(value))
+
+    def add(self, namespace, key, value):
+        return bool(self.client.hsetnx(self._hash(namespace), key, self._dumps(value)))
+
+    def delete(self, namespace, key):
+        return self.client.hdel(self._hash(namespace), key) > 0
+
+    def delete_if(self, namespace, key, expected):
+        name = self._hash(namespace)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    raw = pipe.hget(name, key)
+                    if raw is None or self._loads(raw) != expected:
+                        pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    pipe.hdel(name, key)
+                    pipe.execute()
+                    return True
+                except self._redis.WatchError:
+                    continue
+
+    def exists(self, namespace, key):
+        return bool(self.client.hexists(self._hash(namespace), key))
+
+    def keys(self, namespace):
+        return list(self.client.hkeys(self._hash(namespace)))
+
+    def values(self, namespace):
+        return [self._loads(raw) for raw in self.client.hvals(self._hash(namespace))]
+
+    def update(self, namespace, key, fields, nested=None, increments=None):
+        name = self._hash(namespace)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    raw = pipe.hget(name, key)
+                    if raw is None:
+                        pipe.unwatch()
+                        return None
+                    value = self._loads(raw)
+                    self._merge(value, fields, nested, increments)
+                    pipe.multi()
+                    pipe.hset(name, key, self._dumps(value))
+                    pipe.execute()
+                    return value
+                except self._redis.WatchError:
+                    continue
+
+    def _log_keys(self, namespace: str) -> List[str]:
+        return [f"{self.prefix}:logseq:{namespace}", f"{self.prefix}:changes:{namespace}"]
+
+    def append_log(self, namespace, entry):
+        # Numbering and appending in one script keeps the list in sequence order across clients
+        seq = self._append_script(keys=self._log_keys(namespace), args=[self._dumps(entry)])
+        self._compact_log(namespace, seq)
+        return seq
+
+    def read_log(self, namespace, after=0):
+        _, log = self._log_keys(namespace)
+        first = self.client.lindex(log, 0)
+        if first is None:
+            return []
+        # Entries are contiguous, so the list index follows from the oldest retained sequence number
+        start = max(0, after - json.loads(first)["seq"] + 1)
+        records = [json.loads(raw) for raw in self.client.lrange(log, start, -1)]
+        return [(record["seq"], record["entry"]) for record in records if record["seq"] > after]
+
+    def log_tail(self, namespace):
+        return int(self.client.get(self._log_keys(namespace)[0]) or 0)
+
+    def trim_log(self, namespace, upto):
+        _, log = self._log_keys(namespace)
+        first = self.client.lindex(log, 0)
+        if first is not None:
+            drop = upto - json.loads(first)["seq"] + 1
+            if drop > 0:
+                self.client.ltrim(log, drop, -1)
+
+
+# Namespace holding the last-change version of each versioned collection
+VERSIONS_NAMESPACE = "_versions"
+
+
+class StateCollection(MutableMapping):
+    """Dict-style view over one namespace of a state backend.
+
+    A versioned collection stamps every written value with a ``version`` and
+    tracks a collection-wide version, both of which change on every write.
+    Collections nobody lists can skip the collection-wide version with
+    ``collection_version=False``, sparing every write a shared hot row.
+    """
+
+    def __init__(self, backend: StateBackend, namespace: str, versioned: bool = False, collection_version: bool = True):
+        self.backend = backend
+        self.namespace = namespace
+        self.versioned = versioned
+        self.collection_version = collection_version
+
+    def _next_version(self) -> int:
+        # Nanosecond clock rather than a counter: unique per write without a read-modify-write
+        version = time.time_ns()
+        if self.collection_version:
+            self.backend.set(VERSIONS_NAMESPACE, self.namespace, {"version": version})
+        return version
+
+    def version(self) -> int:
+        """Version of the most recent write to the collection"""
+        record = self.backend.get(VERSIONS_NAMESPACE, self.namespace)
+        return record["version"] if record else 0
+
+    def __getitem__(self, key: str) -> Dict[str, Any]:
+        value = self.backend.get(self.namespace, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Dict[str, Any]) -> None:
+        if self.versioned:
+            value = {**value, "version": self._next_version()}
+        self.backend.set(self.namespace, key, value)
+
+    def __delitem__(self, key: str) -> None:
+        if not self.backend.delete(self.namespace, key):
+            raise KeyError(key)
+        if self.versioned:
+            self._next_version()
+
+    def __contains__(self, key) -> bool:
+        return self.backend.exists(self.namespace, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.backend.keys(self.namespace))
+
+    def __len__(self) -> int:
+        return len(self.backend.keys(self.namespace))
+
+    def get(self, key: str, default=None):
+        value = self.backend.get(self.namespace, key)
+        return default if value is None else value
+
+    def values(self) -> List[Dict[str, Any]]:
+        return self.backend.values(self.namespace)
+
+    def add(self, key: str, value: Dict[str, Any]) -> bool:
+        """Store ``value`` unless ``key`` already exists, returning whether it was stored"""
+        if self.versioned:
+            value = {**value, "version": self._next_version()}
+        return self.backend.add(self.namespace, key, value)
+
+    def delete_if(self, key: str, expected: Dict[str, Any]) -> bool:
+        """Delete ``key`` only if no one has changed it since ``expected`` was read"""
+        deleted = self.backend.delete_if(self.namespace, key, expected)
+        if deleted and self.versioned:
+            self._next_version()
+        return deleted
+
+    def update_fields(self, key: str, **fields) -> Optional[Dict[str, Any]]:
+        if self.versioned:
+            fields["version"] = self._next_version()
+        return self.backend.update(self.namespace, key, fields)
+
+    def merge_fields(self, key: str, nested: Dict[str, Dict[str, Any]], **fields) -> Optional[Dict[str, Any]]:
+        """Like ``update_fields``, also merging each of ``nested`` into the dict field of that name"""
+        if self.versioned:
+            fields["version"] = self._next_version()
+        return self.backend.update(self.namespace, key, fields, nested)
+
+    def increment_fields(self, key: str, **amounts: int) -> Optional[Dict[str, Any]]:
+        """Atomically add ``amounts`` to numeric fields of an existing value"""
+        fields = {"version": self._next_version()} if self.versioned else {}
+        return self.backend.update(self.namespace, key, fields, increments=amounts)
+
+
+def create_state_backend() -> StateBackend:
+    """Build the backend selected by the STATE_BACKEND setting"""
+    backend = config('STATE_BACKEND', default='sqlite').lower()
+    if backend == "memory":
+        return MemoryStateBackend()
+    if backend == "sqlite":
+        return SQLiteStateBackend(
+            config('STATE_SQLITE_PATH', default='state.db'),
+            config('STATE_SQLITE_TIMEOUT', default=5.0, cast=float)
+        )
+    if backend == "redis":
+        return RedisStateBackend(
+            config('STATE_REDIS_URL', default='redis://localhost:6379/0'),
+            config('STATE_REDIS_PREFIX', default='storyteller')
+        )
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+
+
+state_backend = create_state_backend()
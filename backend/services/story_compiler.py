@@ -0,0 +1,172 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Dict, List, Optional
+from services.gemini_service import GeminiService
+from services.state_backend import StateBackend
+
+BUNDLE_NAMESPACE = "story_bundles"
+BUNDLE_DIR = "static/bundles"
+# Bundles are immutable once compiled, so workers keep a few of them in memory
+BUNDLE_CACHE_SIZE = 32
+# Gemini calls per scene before compilation gives up on the story
+COMPILE_ATTEMPTS = 3
+
+
+class CompileError(Exception):
+    """A scene could not be generated, so the story was not compiled"""
+
+
+class StoryCompiler:
+    """Precomputes a story's choice tree into a static bundle.
+
+    A bundle maps node ids to a scene and its choices; each choice points at the
+    node it leads to, or ``None`` past the compiled depth. Interactive sessions
+    walk the bundle without calling Gemini until they step off its edge, so
+    scenes are never compiled from Gemini's fallback text.
+    """
+
+    def __init__(self, gemini_service: GeminiService, backend: StateBackend):
+        self.gemini_service = gemini_service
+        self.bundles_db = backend.collection(BUNDLE_NAMESPACE)
+        self.stories_db = backend.collection("stories", versioned=True)
+        self._cache: Dict[str, dict] = {}
+
+    async def compile(
+        self,
+        story: dict,
+        depth: int = 3,
+        branching: int = 3,
+        concurrency: int = 4,
+        include_media: bool = True
+    ) -> dict:
+        """Walk the choice tree ``depth`` choices deep, following at most ``branching`` choices per scene"""
+        semaphore = asyncio.Semaphore(concurrency)
+        nodes: Dict[str, dict] = {}
+        counter = iter(range(1, 1 << 30))
+
+        root_scene = story["enhanced_content"][:500]
+        nodes["n0"] = {
+            "scene": root_scene,
+            "choices": [
+                {
+                    "choice_id": f"choice_{i+1}",
+                    "choice_text": choice.get("choice_text", f"Choice {i+1}"),
+                    "consequence": choice.get("consequence", f"You chose option {i+1}"),
+                    "next": None
+                }
+                for i, choice in enumerate(story.get("choices", []))
+            ]
+        }
+        if include_media:
+            nodes["n0"]["audio_url"] = story.get("audio_url")
+            nodes["n0"]["image_url"] = story.get("image_url")
+
+        async def expand(node_id: str, history: List[str], remaining: int):
+            if remaining <= 0:
+                return
+            children = []
+            for choice in nodes[node_id]["choices"][:branching]:
+                child_id = f"n{next(counter)}"
+                choice["next"] = child_id
+                children.append((child_id, choice))
+
+            async def build(child_id: str, choice: dict):
+                async with semaphore:
+                    scene = await self._attempt(
+                        self.gemini_service.continue_interactive_story, history, choice["choice_text"], strict=True
+                    )
+                    choices = await self._attempt(
+                        self.gemini_service.generate_interactive_choices, story["enhanced_content"], scene, strict=True
+                    )
+                nodes[child_id] = {
+                    "scene": scene,
+                    "choices": [{**c.model_dump(), "next": None} for c in choices]
+                }
+                await expand(child_id, history + [scene], remaining - 1)
+
+            await asyncio.gather(*(build(child_id, choice) for child_id, choice in children))
+
+        await expand("n0", [root_scene], depth)
+
+        return {
+            "bundle_id": str(uuid.uuid4()),
+            "story_id": story["story_id"],
+            # Version of the story text the tree was compiled from
+            "story_version": story.get("version"),
+            "language": story.get("language", "en"),
+            "depth": depth,
+            "branching": branching,
+            "compiled_at": int(time.time()),
+            "root": "n0",
+            "nodes": nodes
+        }
+
+    @staticmethod
+    async def _attempt(call, *args, **kwargs):
+        for attempt in range(1, COMPILE_ATTEMPTS + 1):
+            try:
+                return await call(*args, **kwargs)
+            except Exception as e:
+                if attempt == COMPILE_ATTEMPTS:
+                    raise CompileError(f"Gemini failed {COMPILE_ATTEMPTS} times: {str(e)}") from e
+
+    def save(self, bundle: dict) -> str:
+        """Publish a bundle to the state backend and as a static file, returning the file path.
+
+        Raises ``CompileError`` if the story was updated or deleted since compiling began.
+        """
+        self._check_current(bundle)
+        os.makedirs(BUNDLE_DIR, exist_ok=True)
+        path = os.path.join(BUNDLE_DIR, f"{bundle['story_id']}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(bundle, f, ensure_ascii=False, separators=(",", ":"))
+        self.bundles_db[bundle["story_id"]] = bundle
+        try:
+            # The story may have changed between the check and the write; never leave that bundle behind
+            self._check_current(bundle)
+        except CompileError:
+            self.invalidate(bundle["story_id"])
+            raise
+        return path
+
+    def _is_current(self, bundle: dict, story: Optional[dict]) -> bool:
+        return story is not None and bundle.get("story_version") == story.get("version")
+
+    def _check_current(self, bundle: dict) -> None:
+        if not self._is_current(bundle, self.stories_db.get(bundle["story_id"])):
+            raise CompileError(f"Story {bundle['story_id']} changed while it was being compiled")
+
+    def invalidate(self, story_id: str) -> None:
+        """Drop a story's bundle once the story changes, so new sessions play it live"""
+        self.bundles_db.pop(story_id, None)
+        for bundle_id in [b for b, bundle in self._cache.items() if bundle["story_id"] == story_id]:
+            del self._cache[bundle_id]
+        try:
+            os.remove(os.path.join(BUNDLE_DIR, f"{story_id}.json"))
+        except FileNotFoundError:
+            pass
+
+    def load(self, story_id: str, story: Optional[dict] = None) -> Optional[dict]:
+        """Current bundle for a story, if one has been compiled from its current text"""
+        bundle = self.bundles_db.get(story_id)
+        if not bundle:
+            return None
+        if not self._is_current(bundle, story if story is not None else self.stories_db.get(story_id)):
+            return None
+        self._remember(bundle)
+        return bundle
+
+    def get(self, bundle_id: str, story_id: str) -> Optional[dict]:
+        """A specific bundle version, as pinned by a session"""
+        bundle = self._cache.get(bundle_id)
+        if bundle is None:
+            bundle = self.load(story_id)
+        return bundle if bundle and bundle["bundle_id"] == bundle_id else None
+
+    def _remember(self, bundle: dict) -> None:
+        if len(self._cache) >= BUNDLE_CACHE_SIZE:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[bundle["bundle_id"]] = bundle
@@ -1,15 +1,55 @@
+import asyncio
 import requests
 from decouple import config
 import aiofiles
 from PIL import Image
 import io
+import os
+import uuid
+from typing import Optional, Tuple
+from services.deadline import Deadline, call_with_deadline
+
+def _post_image_request(url: str, **kwargs) -> requests.Response:
+    """POST to Stability, treating throttling and server errors as provider failures"""
+    response = requests.post(url, **kwargs)
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RuntimeError(f"Stability API returned {response.status_code}")
+    return response
+
+def _temp_path(output_path: str) -> str:
+    """Unique sibling path to write to before renaming over ``output_path``"""
+    return f"{output_path}.{uuid.uuid4().hex}.tmp"
+
+async def _write_atomic(output_path: str, content: bytes) -> None:
+    # Other workers treat an existing file as finished, so it only appears once complete
+    temp_path = _temp_path(output_path)
+    try:
+        async with aiofiles.open(temp_path, 'wb') as f:
+            await f.write(content)
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# Styles generate_image has prompts for
+IMAGE_STYLES = ("illustration", "realistic", "cartoon", "traditional_art")
 
 class VisualService:
     def __init__(self):
         self.stability_api_key = config('STABILITY_API_KEY', default='')
         
-    async def generate_image(self, description: str, output_path: str, style: str = "illustration"):
-        """Generate cultural artwork based on story descriptions using Stability AI's SD3.5 model"""
+    async def generate_image(
+        self,
+        description: str,
+        output_path: str,
+        style: str = "illustration",
+        deadline: Optional[Deadline] = None,
+        strict: bool = False
+    ):
+        """Generate cultural artwork based on story descriptions using Stability AI's SD3.5 model.
+
+        With ``strict`` set, no placeholder is written and any failure returns False.
+        """
         try:
             # Style-specific prompts
             style_prompts = {
@@ -38,25 +78,55 @@ class VisualService:
                 "output_format": "jpeg"
             }
             
-            response = requests.post(
+            deadline = deadline or Deadline.for_endpoint("image")
+            response = await call_with_deadline(
+                f"stability:{data['model']}",
+                _post_image_request,
                 url,
+                deadline=deadline,
                 headers=headers,
                 files={"none": ''},  # Required by the API
-                data=data
+                data=data,
+                timeout=deadline.remaining()
             )
             
             if response.status_code == 200:
-                async with aiofiles.open(output_path, 'wb') as f:
-                    await f.write(response.content)
+                await _write_atomic(output_path, response.content)
                 return True
             
+            if strict:
+                print(f"Error generating image: Stability API returned {response.status_code}")
+                return False
+            
             # Fallback: Create a placeholder image
             await self._create_placeholder_image(output_path, description)
             return True
             
         except Exception as e:
             print(f"Error generating image: {str(e)}")
-            await self._create_placeholder_image(output_path, "Cultural Story Scene")
+            if not strict:
+                await self._create_placeholder_image(output_path, "Cultural Story Scene")
+            return False
+    
+    async def create_thumbnail(self, image_path: str, output_path: str, size: Tuple[int, int] = (320, 320)) -> bool:
+        """Write a downscaled JPEG copy of a generated image for list and card views"""
+        def resize():
+            temp_path = _temp_path(output_path)
+            try:
+                with Image.open(image_path) as img:
+                    img = img.convert("RGB")
+                    img.thumbnail(size)
+                    img.save(temp_path, "JPEG", quality=80, optimize=True)
+                os.replace(temp_path, output_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, resize)
+            return True
+        except Exception as e:
+            print(f"Error creating thumbnail: {str(e)}")
             return False
     
     async def _create_placeholder_image(self, output_path: str, text: str):
@@ -66,8 +136,9 @@ class VisualService:
             img = Image.new('RGB', (512, 512), color='lightblue')
             
             # Save the placeholder
-            with open(output_path, 'wb') as f:
-                img.save(f, 'PNG')
+            buffer = io.BytesIO()
+            img.save(buffer, 'PNG')
+            await _write_atomic(output_path, buffer.getvalue())
                 
         except Exception as e:
             print(f"Error creating placeholder: {str(e)}")
@@ -1,4 +1,21 @@
+// Origin of the API, which picks narration quality from network client hints
+const apiOrigin = new URL(process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8000/api/v1').origin;
+
 /** @type {import('next').NextConfig} */
-const nextConfig = {}
+const nextConfig = {
+  async headers() {
+    return [
+      {
+        // Browsers only send ECT and Downlink once a page asks for them, and only
+        // to other origins the page delegates them to
+        source: '/:path*',
+        headers: [
+          { key: 'Accept-CH', value: 'ECT, Downlink' },
+          { key: 'Permissions-Policy', value: `ch-ect=(self "${apiOrigin}"), ch-downlink=(self "${apiOrigin}")` },
+        ],
+      },
+    ];
+  },
+}
 
 module.exports = nextConfig
@@ -76,7 +76,9 @@ export default function StoryPage({ params }: StoryPageProps) {
     if (!currentSegment) return;
     setIsGeneratingVisual(true);
     try {
-      const imageUrl = await storyApi.generateImage(currentSegment.text, visualStyle);
+      const imageUrl = currentSegment.session_id
+        ? await storyApi.getSceneMedia(currentSegment.session_id, 'image', visualStyle)
+        : await storyApi.generateImage(currentSegment.text, visualStyle);
       setCurrentSegment(prev => prev ? { ...prev, imageUrl } : null);
       setIsVisualGenerated(true);
     } catch (err) {
@@ -107,6 +109,13 @@ export default function StoryPage({ params }: StoryPageProps) {
       setIsAudioGenerated(!!nextSegment.audioUrl);
       setIsVisualGenerated(!!nextSegment.imageUrl);
       
+      // Scene art loads in the background; it is usually ready already when the scene was prefetched
+      storyApi.getSceneMedia(currentSegment.session_id, 'image', visualStyle).then(imageUrl => {
+        if (!imageUrl) return;
+        setCurrentSegment(prev => prev && prev.text === nextSegment.text ? { ...prev, imageUrl } : prev);
+        setIsVisualGenerated(true);
+      });
+      
       window.scrollTo({ top: 0, behavior: 'smooth' });
     } catch (err) {
       const errorMessage = err instanceof Error ? err.message : 'Failed to process your choice';
@@ -2,6 +2,16 @@ import { StoryInput, StorySegment } from '../types/story';
 
 const API_BASE_URL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8000/api/v1';
 
+// Backend image style closest to each visual style offered when creating a story
+const IMAGE_STYLES: Record<string, string> = {
+  'Anime': 'cartoon',
+  'Photorealistic': 'realistic',
+  'Cinematic': 'realistic',
+  'Oil Painting': 'traditional_art',
+  'Watercolor': 'traditional_art',
+  'Digital Art': 'illustration',
+};
+
 // Helper function to handle API requests
 async function fetchAPI(endpoint: string, options: RequestInit = {}) {
   const url = `${API_BASE_URL}${endpoint}`;
@@ -215,14 +225,8 @@ export const storyApi = {
         throw new Error('Empty response from server');
       }
 
-      // Generate image for the new scene if needed
+      // Scene art is requested separately through getSceneMedia so choices are not held up by it
       const currentScene = response.current_scene || response.scene || 'The story continues...';
-      const imageUrl = currentScene 
-        ? await this.generateImage(
-            `Create an image for this story scene: ${currentScene.substring(0, 200)}`,
-            'vivid'
-          )
-        : '';
 
       // Map the choices correctly from the response
       const choices = Array.isArray(response.choices) 
@@ -236,7 +240,7 @@ export const storyApi = {
       const segment: StorySegment = {
         id: sessionId,
         text: currentScene,
-        imageUrl: imageUrl,
+        imageUrl: '',
         audioUrl: response.audio_url || '',
         session_id: sessionId,
         current_scene: currentScene,
@@ -300,6 +304,36 @@ export const storyApi = {
     }
   },
 
+  // Media for a session's current scene, shared with other sessions at the same scene and style.
+  // Polls until the server has generated it; resolves to '' if it fails or times out.
+  async getSceneMedia(
+    sessionId: string,
+    kind: 'image' | 'audio',
+    visualStyle?: string,
+    timeoutMs: number = 60000
+  ): Promise<string> {
+    const deadline = Date.now() + timeoutMs;
+    const style = IMAGE_STYLES[visualStyle || ''] || 'illustration';
+    try {
+      while (Date.now() < deadline) {
+        const response = await fetchAPI(`/interactive/session/${sessionId}/scene-media?kinds=${kind}&style=${style}`, {
+          method: 'POST',
+        });
+        const media = response.media?.[kind];
+        if (media?.status === 'completed' && media.url) {
+          return new URL(media.url, API_BASE_URL).toString();
+        }
+        if (media?.status === 'failed') {
+          return '';
+        }
+        await new Promise(resolve => setTimeout(resolve, 2000));
+      }
+    } catch (error) {
+      console.error(`Error loading scene ${kind}:`, error);
+    }
+    return '';
+  },
+
   // Generate image based on story description
   async generateImage(description: string, style: string = 'illustration'): Promise<string> {
     if (!description) return '';